@@ -12,8 +12,19 @@ config_path = "data/config.json"
 # path to the best weights, taken from the training enviroment
 weights_path = "data/best_weights_11.h5"
 
-# Kivy resizes the camera image to size before displaying
-frame_size = 1180, 1180
+# exported TensorFlow Lite model (see engines.py), or None to run the Keras model
+tflite_path = None
+
+# run inference in a separate worker process instead of a thread (see worker.py)
+inference_process = False
+
+# where frames come from: "picamera", "synthetic", "images:<folder>" or "video:<path>"
+frame_source = "picamera"
+
+# per-stage latency metrics (see metrics.py): served as text on this local port
+# (None to disable) and rewritten to this file every 10 seconds (None to disable)
+metrics_port = 8001
+metrics_path = "data/metrics.txt"
 
 # ====================
 # Initialise LED Strip
@@ -21,182 +32,107 @@ frame_size = 1180, 1180
 
 print("[i] Initialising LED Strip")
 
-from neopixel import *
-from threading import Thread
 import time
+from leds import LEDController, MockStrip, progress_bar, RED, GREEN, BLUE
 
-red = Color(0, 255, 0)
-green = Color(255, 0, 0)
-blue = Color(0, 0, 255)
-yellow = Color(255, 255, 0)
-
-# Create NeoPixel object with appropriate configuration.
-strip = Adafruit_NeoPixel(25, 18, 800000, 10, False, 100, 0)
+try:
+    from neopixel import Adafruit_NeoPixel
+    # Create NeoPixel object with appropriate configuration.
+    strip = Adafruit_NeoPixel(25, 18, 800000, 10, False, 100, 0)
+except ImportError:
+    print("[!] No LED strip library, using an in-memory strip")
+    strip = MockStrip(25)
 
 # Intialize the library (must be called once before other functions).
 strip.begin()
 
+# the controller thread owns the strip: it only calls the blocking strip.show()
+# when the colours change, and never on the UI thread
+leds = LEDController(strip).start()
+
 
-class lightshow():
+def import_ui():
     """
-    A thread that's sole purpose is to show you the loading progress.
-    The model takes around 110 seconds to load, so that's what the progress bar shows you.
-    It's a bit naive, but it's also here for fun.
+    Configure Kivy and import the UI modules, so that the imports in the
+    GUI Setup below are already loaded. The window itself is created on the main thread.
     """
-
-    def __init__(self):
-        # Initiate properties
-        global strip
-        self.stopped = False
-        self.start_time = None
-        self.progress = 0
-        self.pixels = strip.numPixels()
-
-    def start(self):
-        # start the thread to read frames from the video stream
-        self.start_time = time.time()
-        Thread(target=self.update, args=()).start()
-        return self
-
-    def update(self):
-        # keep looping infinitely until the thread is stopped
-        global strip, yellow, green
-        while True:
-            if self.stopped:
-                return
-            elif self.progress == 100:
-                self.stop()
-            else:
-                time.sleep(0.6)
-                self.progress += 0.5
-                for i in range(int((self.progress+4.4)/100*self.pixels)):
-                    strip.setPixelColor(i, red)
-                for i in range(int((self.progress+2.6)/100*self.pixels)):
-                    strip.setPixelColor(i, yellow)
-                for i in range(int(self.progress/100*self.pixels)):
-                    strip.setPixelColor(i, green)
-                strip.show()
-
-    def stop(self):
-        self.stopped = True
+    from kivy.config import Config
+    Config.set('graphics', 'fullscreen', 'fake')
+    Config.set('graphics', 'fbo', 'hardware')
+    Config.set('graphics', 'show_cursor', 1)
+    Config.set('graphics', 'borderless', 0)
+    Config.set('kivy', 'exit_on_escape', 1)
+    Config.write()
+
+    import kivy.app
+    import kivy.graphics
+    import kivy.lang
+    import kivy.clock
+    import kivy.uix.screenmanager
+    import display
+    import pacing
 
 # ====================================
-# Computer Vision Pipeline
-#   Components (as threads):
-#     1. Camera stream (PiVideoStream)
-#     2. Inference (prediction) stream
+# Startup
+#   Startup tasks run concurrently as a dependency graph (see startup.py):
+#     1. Camera stream (open_source)
+#     2. Model loading, in this process or an inference worker process
+#     3. Self-test, then the inference (prediction) stream, once 1. and 2. are done
+#     4. Kivy configuration and UI imports
 # ====================================
 
 
-# start the progress bar animation
-progress_bar = lightshow().start()
+from startup import StartupGraph
+from pipeline import Pipeline
 
 print("[i] Initialising Computer Vision pipeline")
-import cv2
-import json
-import numpy as np
-from box_utils import draw_boxes
-from object_detection_model import ObjectDetection
-
-with open(config_path) as config_buffer:
-    config = json.load(config_buffer)
-
-from camera import PiVideoStream
-
+pipeline = Pipeline(config_path, weights_path, tflite_path, frame_source, inference_process)
+config = pipeline.config
 print("[i] Loading feature extractor:", config['model']['backend'])
 print("[+] Trained labels:", config['model']['labels'])
-print("[i] Building model... This will take a while... (< 2 mins)")
-
-load_start = time.time()
-
-model = ObjectDetection(backend=config['model']['backend'],
-                        input_size=config['model']['input_size'],
-                        labels=config['model']['labels'],
-                        max_box_per_image=config['model']['max_box_per_image'],
-                        anchors=config['model']['anchors'])
-
-print("[i] Model took", (time.time()-load_start), "seconds to load")
 
-print("[c] Starting video capture")
-cap = PiVideoStream().start()
+startup = StartupGraph("data/cache/startup_tasks.json")
+pipeline.add_startup_tasks(startup)
+startup.add('ui', import_ui, weight=10.)
 
-print("[i] Loading weights from", weights_path)
-model.load_weights(weights_path)
+# start the progress bar animation, driven by the startup tasks
+leds.animate(progress_bar(startup.progress, strip.numPixels()))
 
+try:
+    startup.run()
+except Exception as error:
+    leds.stop()
+    pipeline.stop()
+    print("[!] Fatal error", end=": ")
+    print(error)
+    exit()
 
-class predictions():
-    """
-    Streaming inferences independently of camera and UI updates
-    Makes use of the following global variables:
-      1. current frame from camera stream
-      2. currently loaded object detection model
-    """
-
-    def __init__(self):
-        self.boxes = ["can", "bottle", "ken",
-                      "grace", "frank", "tim", "shelly"]
-        self.stopped = False
-
-    def start(self):
-        # start the thread to read frames from the video stream
-        Thread(target=self.update, args=()).start()
-        return self
-
-    def update(self):
-        global model, frame
-        # keep looping infinitely until the thread is stopped
-        while True:
-            if self.stopped:
-                return
-            else:
-                self.boxes = model.predict(frame)
-
-    def read(self):
-        return self.boxes
-
-    def stop(self):
-        self.stopped = True
+startup.report()
 
 # =========
 # IOT Setup
 #   1. Import firebase iot functions
 #   2. Authenticate and instantiate firebase
 #   3. Reset firebase on first run
+#   4. Open the local event log, replicated to firebase in the background
+#   5. Draw the statistics charts in the background
 # =========
 
 
 from iot import *
+from event_log import EventLog
+from charts import ChartService, ChartDisplay
 #firebase = firebase_setup()
 # firebase_reset(firebase)
-
-# ======================================================
-# Perform one inference to test if everything is working
-# ======================================================
-
-print("[i] Running self-test")
-try:
-    frame = cap.read()  # read one frame from the stream
-    boxes = model.predict(frame)  # get bounding boxes
-    # if previous line succeded, our model is functional; start the predictions stream
-    pred = predictions().start()
-    print("[+] Self-test: OK")
-except Exception as error:
-    print("[!] Fatal error", end=": ")
-    print(error)
-    exit()
-
-# ==============================
-# Kivy Configuration
-#   Only needed on the first run
-# ==============================
-
-from kivy.config import Config
-Config.set('graphics', 'fullscreen', 'fake')
-Config.set('graphics', 'fbo', 'hardware')
-Config.set('graphics', 'show_cursor', 1)
-Config.set('graphics', 'borderless', 0)
-Config.set('kivy', 'exit_on_escape', 1)
-Config.write()
+# every recycling event is recorded locally first, so none are lost while offline
+events_log = EventLog()
+#from event_log import SyncWorker
+#sync = SyncWorker(events_log, firebase).start()
+# and/or to the fleet collector (see fleet.py), as bin KIOSK
+#from fleet import BinClient, FleetUploader
+#fleet = FleetUploader(events_log, BinClient("http://127.0.0.1:8002", KIOSK)).start()
+# redrawn off the UI thread, only when the numbers change
+charts = ChartService(events_log).start()
 
 # ========================
 # GUI Setup
@@ -205,11 +141,17 @@ Config.write()
 
 from kivy.app import App
 from kivy.graphics import *
-from kivy.graphics.texture import Texture
 from kivy.lang import Builder
 from kivy.clock import Clock
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.core.window import Window
+from display import CameraDisplay, BoxOverlay
+from pacing import FramePacer, Stage
+from metrics import METRICS
+
+if metrics_port is not None:
+    METRICS.serve(metrics_port)
+    print("[i] Serving metrics at http://127.0.0.1:{}/metrics".format(metrics_port))
 
 Builder.load_file('app_layout.kv')  # Kivy layout file
 
@@ -223,119 +165,140 @@ class MainView(Screen):
     """
 
     def __init__(self, **kwargs):
-        global cap, frame, frame_size
-
-        # capture and render the first frame
-        self.frame_size = frame_size
-        frame = cap.read()
-        image = cv2.flip(frame, 0)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = cv2.resize(image, frame_size)
-        buf = image.tostring()
-        self.image_texture = Texture.create(size=(image.shape[1], image.shape[0]), colorfmt='rgb')
-        self.image_texture.blit_buffer(buf, colorfmt='rgb', bufferfmt='ubyte')
+        global pipeline
 
         # coordinates of Trashy
         self.t_x = 0
         self.t_y = 0
 
         self.current_user = 'No user yet'
-        self.tickcount = 0
-        self.labels = ["can", "bottle", "ken",
-                       "grace", "frank", "tim", "shelly"]
         self.users = ["ken", "grace", "frank", "tim", "shelly"]
+        self.metrics_written = 0.
 
         super(MainView, self).__init__(**kwargs)
-        Clock.schedule_interval(self.tick, 0.06)
-
-    def tick(self, dt):
-        global pred, cap, frame, strip, red, green, blue
-        #global firebase
-
-        can_detected, bottle_detected = False, False
-        #self.tickcount += 1
-
-        # Process frame from OpenCV
-        frame = cap.read()
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        boxes = pred.read()
-        image = draw_boxes(image, boxes, config['model']['labels'])
-        image = cv2.resize(cv2.flip(image, 0), self.frame_size)
-        buf = image.tostring()
 
-        # Update displayed image in user interface camera view
-        self.image_texture = Texture.create(
-            size=(self.frame_size), colorfmt='rgb')
-        self.image_texture.blit_buffer(buf, colorfmt='rgb', bufferfmt='ubyte')
-        self.ids.cameraView.texture = self.image_texture
+        # one persistent texture for the camera view, scaled to the widget on the GPU,
+        # with the bounding boxes drawn over it as canvas instructions
+        self.camera_display = CameraDisplay(self.ids.cameraView, pipeline.source.read().shape)
+        self.box_overlay = BoxOverlay(self.ids.cameraView, pipeline.labels)
+        self.camera_display.update(pipeline.source)
+
+        # the label text, LEDs and IoT only change on debounced detection events
+        pipeline.events.subscribe(self.on_detection_event)
+        self.show_recyclables(set())
+
+        # each stage runs at its own rate and time budget (see pacing.py);
+        # under load the inference cadence and the display slow down first
+        # and overlay redraws are skipped, the detection events are kept on time
+        self.pacer = FramePacer(resolution=0.02)
+        self.pacer.add(Stage('decision', self.update_decision, 0.1, budget=0.01, priority=4))
+        self.pacer.add(Stage('display', self.update_display, 0.06, budget=0.03,
+                             max_interval=0.2, priority=2))
+        self.pacer.add(Stage('overlay', self.update_overlay, 0.06, budget=0.02,
+                             max_interval=0.25, priority=1, skippable=True))
+        self.pacer.add(Stage('inference', None, 0.1, max_interval=1.0, priority=0,
+                             on_interval=lambda interval: setattr(pipeline.pred, 'min_interval', interval)))
+        self.pacer.add(Stage('metrics', self.update_metrics, 1., budget=0.02, priority=5))
+        self.pacer.add(Stage('log', self.log, 30., budget=1., priority=5))
+
+        Clock.schedule_interval(self.pacer.tick, self.pacer.resolution)
+
+    def update_metrics(self, dt):
+        pipeline.collect_metrics()
+        if self.ids.metricsView.opacity > 0:
+            self.ids.metricsView.text = "\n".join(
+                "{:<15} p50 {:6.1f}  p95 {:6.1f}  p99 {:6.1f} ms  {:5.1f}/s".format(
+                    stage, report['p50'] * 1000, report['p95'] * 1000, report['p99'] * 1000, report['rate'])
+                for stage, report in METRICS.snapshot().items())
+        if metrics_path is not None and time.time() - self.metrics_written > 10:
+            self.metrics_written = time.time()
+            METRICS.write(metrics_path)
+
+    def toggle_metrics(self):
+        """Show or hide the per-stage latency overlay"""
+        self.ids.metricsView.opacity = 0.0 if self.ids.metricsView.opacity > 0 else 1.0
+        self.update_metrics(0)
+
+    def log(self, dt):
+        self.pacer.log()
+        METRICS.log()
+
+    def current_boxes(self):
+        """Detections extrapolated to the frame on screen"""
+        return pipeline.detections(self.camera_display.frame_time)
+
+    def update_display(self, dt):
+        # Upload the newest camera frame (if there is one) into the camera view
+        self.camera_display.update(pipeline.source)
+
+    def update_overlay(self, dt):
+        boxes = self.current_boxes()
+        self.box_overlay.update(boxes)
 
         if len(boxes) > 0:
             # Trashy avatar follows the bounding box of the detected entity
             # Augmented Reality :)
-            self.t_x = int((boxes[0].xmin-0.5) * 1000) - 80
-            self.t_y = -1 * (int((boxes[0].ymin-0.5) * 1000) + 80)
+            self.t_x = int((boxes.xmin[0]-0.5) * 1000) - 80
+            self.t_y = -1 * (int((boxes.ymin[0]-0.5) * 1000) + 80)
             self.ids.trashyView.opacity = 1.0
             self.ids.trashyView.pos = (self.t_x, self.t_y)
+        else:
+            # Trashy avatar disappears
+            self.ids.trashyView.opacity = 0.0
+
+    def update_decision(self, dt):
+        # new detections are voted into events, dispatched to on_detection_event
+        pipeline.update()
+
+    def on_detection_event(self, event):
+        if event.kind == 'user_identified':
+            # Update current user property when a valid entity label is detected
+            if event.label in self.users:
+                self.current_user = event.label
+            return
+
+        if event.kind == 'left':
+            # Record the item once it has been thrown away with a valid user; this never blocks
+            if self.current_user in self.users:
+                firebase_update(events_log, self.current_user, event.label + 's', 1, event.confidence)
+
+        self.show_recyclables(pipeline.events.present_recyclables())
+
+    def show_recyclables(self, recyclables):
+        """Update the label text and LED strip for the recyclables in front of the bin"""
+        if recyclables:
             display_label = ""
-            for box in boxes:
-                # Obtain current entity prediction label
-                curr_label = box.get_label()
-                if self.labels[curr_label] == "can":
-                    can_detected = True
-                if self.labels[curr_label] == "bottle":
-                    bottle_detected = True
-                # if self.labels[curr_label] in self.users:
-                    # Update current user property if a valid entity label is detected
-                 #   self.current_user = self.labels[curr_label]
-
-            if can_detected == True:
-                # Set led lights at the 'cans' box to green to signal user
-                for i in range(8):
-                    strip.setPixelColor(i, red)
-                for i in range(15, 25):
-                    strip.setPixelColor(i, green)
+            zones = {}
+
+            if "can" in recyclables:
                 display_label = display_label + \
                     "\nThrow your can in the recycling bin\nPlease wash the can first!"
+                # Set led lights at the 'cans' box to green to signal user
+                zones['cans'] = GREEN
 
-                # Increment firebase user count for cans by 1 every time a can is detected with a valid user
-                # Also only updates every 10 ticks to reduce lag
-                # if self.current_user in self.users and self.tickcount % 10 == 0:
-                #    firebase_update(firebase, self.current_user, 'cans', 1)
-
-            if bottle_detected == True:
-                # Set led lights at the 'blue' box to green to signal user
-                for i in range(8):
-                    strip.setPixelColor(i, red)
-                for i in range(8, 15):
-                    strip.setPixelColor(i, blue)
+            if "bottle" in recyclables:
                 display_label = display_label + \
                     "\nThrow your bottle into the recycling bin\nPlease empty it first!"
+                # Set led lights at the 'bottles' box to blue to signal user
+                zones['bottles'] = BLUE
 
-                # Increment firebase user count for bottles by 1 every time a bottle is detected with a valid user
-                # Also only updates every 10 ticks to reduce lag
-                # if self.current_user in self.users and self.tickcount % 10 == 0:
-                #    firebase_update(firebase, self.current_user, 'bottles', 1)
             self.ids.labelObjDet.text = display_label
+            leds.set_frame(leds.frame(RED, **zones))
         else:
-            # Trashy avatar disappears and message popup
-            self.ids.trashyView.opacity = 0.0
+            # message popup, and the original state: green status lights
             self.ids.labelObjDet.text = "No recyclable trash detected"
-        strip.show()
-        # reset the LED strip to original state (but don't show it!)
-        for i in range(strip.numPixels()):
-            strip.setPixelColor(i, red)
-        for i in range(8):
-            strip.setPixelColor(i, green)
+            leds.set_frame(leds.frame(RED, status=GREEN))
 
     def quit(self):
         # Stop predictions and video capture
-        global strip
-        pred.stop()
-        cap.stop()
+        pipeline.stop()
         # Turn off led strip
-        for i in range(strip.numPixels()):
-            strip.setPixelColor(i, Color(0, 0, 0))
-        strip.show()
+        leds.stop()
+        # Stop replicating and commit the events still queued
+        #sync.stop()
+        #fleet.stop()
+        charts.stop()
+        events_log.close()
         # Exit kivy
         Window.close()
         App.get_running_app().stop()
@@ -343,10 +306,18 @@ class MainView(Screen):
 
 
 class InfoView(Screen):
-    """Secondary screen that displays information about recycling in Singapore"""
+    """Secondary screen that displays information about recycling in Singapore, and our statistics"""
 
     def __init__(self, **kwargs):
         super(InfoView, self).__init__(**kwargs)
+        # the charts are drawn by the ChartService; this only swaps in the textures that changed
+        self.chart_display = ChartDisplay(charts, {'by_user': self.ids.userChart,
+                                                   'by_category': self.ids.categoryChart})
+        Clock.schedule_interval(self.chart_display.update, 0.5)
+
+    def on_pre_enter(self):
+        # ask for fresh numbers; the charts are only redrawn if they changed
+        charts.refresh()
 
 
 class AboutView(Screen):
@@ -360,12 +331,8 @@ class AboutView(Screen):
 # ==========================================
 
 
-# everything works! set LED strip to initial state
-for i in range(strip.numPixels()):
-    strip.setPixelColor(i, red)
-for i in range(8):
-    strip.setPixelColor(i, green)
-strip.show()
+# everything works! set LED strip to initial state (once the progress bar has finished)
+leds.set_frame(leds.frame(RED, status=GREEN))
 
 print("[u] Loading UI")
 Window.clearcolor = (1, 1, 1, 1)  # set white background
@@ -387,11 +354,8 @@ class SmartBinApp(App):
 try:
     SmartBinApp().run()
 except KeyboardInterrupt:
-    pred.stop()
-    cap.stop()
+    pipeline.stop()
     print('exciting due to KeyboardInterrupt')
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, Color(0, 0, 0))
-    strip.show()
+    leds.stop()
     App.get_running_app().stop()
     exit()
@@ -1,6 +1,10 @@
+import time
+
 import numpy as np
 import cv2
 
+from metrics import METRICS
+
 
 class BoundBox:
     """
@@ -52,99 +56,280 @@ def bbox_iou(box1, box2):
     return float(intersect) / union
 
 
-def draw_boxes(image, boxes, labels):
-    image_h, image_w, _ = image.shape
-
-    for box in boxes:
-        xmin = int(box.xmin*image_w)
-        ymin = int(box.ymin*image_h)
-        xmax = int(box.xmax*image_w)
-        ymax = int(box.ymax*image_h)
-        label = labels[box.get_label()]
-        score = box.get_score()
-        if label == "can":
-            cv2.rectangle(image, (xmin, ymin), (xmax, ymax), (0, 255, 0), 2)
-        elif label == "bottle":
-            cv2.rectangle(image, (xmin, ymin), (xmax, ymax), (0, 255, 255), 2)
-        elif score > 0.7:
-            cv2.rectangle(image, (xmin, ymin),
-                          (xmax, ymax), (255, 255, 255), 2)
-            cv2.putText(image,
-                        labels[box.get_label()] + ' ' +
-                        str(round(score, 2)),
-                        (xmin, ymin - 5),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.4,
-                        (255, 255, 255), 1)
-        else:
-            cv2.rectangle(image, (xmin, ymin), (xmax, ymax), (255, 0, 0), 2)
-            cv2.putText(image,
-                        "No ID",
-                        (xmin, ymin - 5),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.4,
-                        (255, 255, 255), 1)
+class Detections:
+    """
+    Struct-of-arrays container for the boxes decoded from one network output
+    Provides the parallel arrays:
+      1. coords:     (N, 4) xmin, ymin, xmax, ymax (unit: image width/height)
+      2. scores:     (N,) score of the winning class
+      3. labels:     (N,) index of the winning class
+      4. confidence: (N,) objectness of the box
+      5. classes:    (N, nb_class) per-class scores after NMS
+
+    Indexing or iterating yields BoundBox objects for code that still
+    expects the old list-of-boxes interface.
+    """
+
+    def __init__(self, coords, scores, labels, confidence=None, classes=None):
+        self.coords = coords
+        self.scores = scores
+        self.labels = labels
+        self.confidence = confidence
+        self.classes = classes
+
+    @classmethod
+    def empty(cls, nb_class):
+        return cls(np.zeros((0, 4), dtype=np.float32),
+                   np.zeros(0, dtype=np.float32),
+                   np.zeros(0, dtype=np.intp),
+                   np.zeros(0, dtype=np.float32),
+                   np.zeros((0, nb_class), dtype=np.float32))
+
+    @property
+    def xmin(self):
+        return self.coords[:, 0]
+
+    @property
+    def ymin(self):
+        return self.coords[:, 1]
+
+    @property
+    def xmax(self):
+        return self.coords[:, 2]
+
+    @property
+    def ymax(self):
+        return self.coords[:, 3]
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, i):
+        xmin, ymin, xmax, ymax = self.coords[i]
+        box = BoundBox(xmin, ymin, xmax, ymax,
+                       None if self.confidence is None else self.confidence[i],
+                       None if self.classes is None else self.classes[i])
+        box.label = self.labels[i]
+        box.score = self.scores[i]
+        return box
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def box_style(label, score):
+    """
+    How a detected box is shown: (RGB colour, caption or None).
+    Recyclables get a coloured box; anything else is captioned with its
+    label if the model is confident enough, and "No ID" otherwise.
+    """
+    if label == "can":
+        return (0, 255, 0), None
+    elif label == "bottle":
+        return (0, 255, 255), None
+    elif score > 0.7:
+        return (255, 255, 255), label + ' ' + str(round(score, 2))
+    else:
+        return (255, 0, 0), "No ID"
+
 
+class BoxRenderer:
+    """
+    Rasterises detections onto RGB images, styled by box_style.
+    The style of each (label, rounded score) is looked up once, and its caption is
+    rasterised once into a cached sprite that is then only blitted.
+      1. draw(image, detections): draws onto the image in place
+      2. render(frame, detections, frame_id): draws onto a copy of the frame scaled to
+         `size` (e.g. the display resolution), so the lines and text stay crisp instead
+         of being upscaled with the frame. The pixels under the boxes are saved before
+         drawing: for the same frame_id again only those regions are restored and the
+         new boxes drawn, and nothing is done at all if the boxes did not change either
+    """
+
+    def __init__(self, labels, size=None, line_width=2, font_scale=0.4):
+        self.labels = labels
+        self.size = size
+        self.line_width = line_width
+        self.font_scale = font_scale
+        self.styles = {}
+        self.out = None
+        self.frame_id = None
+        self.drawn = None
+        self.saved = []
+
+    def style(self, label_id, score):
+        """(colour, caption sprite or None) of a box; a sprite is (RGB mask, its offset above the box)"""
+        key = (label_id, round(score, 2), score > 0.7)
+        style = self.styles.get(key)
+        if style is None:
+            colour, caption = box_style(self.labels[label_id], score)
+            sprite = None
+            if caption is not None:
+                (width, height), baseline = cv2.getTextSize(caption, cv2.FONT_HERSHEY_SIMPLEX, self.font_scale, 1)
+                mask = np.zeros((height + baseline, width, 3), dtype=np.uint8)
+                cv2.putText(mask, caption, (0, height), cv2.FONT_HERSHEY_SIMPLEX, self.font_scale,
+                            (255, 255, 255), 1)
+                # the text's baseline is 5 pixels above the box
+                sprite = (mask, height + 5)
+            style = self.styles[key] = (colour, sprite)
+        return style
+
+    def layout(self, detections, image_w, image_h):
+        """[(pixel box, colour, sprite)] of the detections"""
+        # scale all boxes to pixel coordinates in one go
+        scale = np.array([image_w, image_h, image_w, image_h], dtype=np.float32)
+        pixels = (detections.coords * scale).astype(np.int32)
+        return [(box, ) + self.style(label_id, score)
+                for box, label_id, score in zip(pixels.tolist(), detections.labels.tolist(),
+                                                detections.scores.tolist())]
+
+    def regions(self, layout, image_w, image_h):
+        """The (y0, y1, x0, x1) slices of the image the boxes' lines and captions cover"""
+        # the lines are centred on the box edges
+        pad = self.line_width
+
+        regions = []
+        for (xmin, ymin, xmax, ymax), colour, sprite in layout:
+            top, bottom, right = ymin - pad, ymin + pad + 1, xmax + pad + 1
+            if sprite is not None:
+                mask, offset = sprite
+                top = min(top, ymin - offset)
+                bottom = max(bottom, ymin - offset + mask.shape[0])
+                right = max(right, xmin + mask.shape[1])
+            # top line (with the caption), bottom, left and right line
+            strips = ((top, bottom, xmin - pad, right),
+                      (ymax - pad, ymax + pad + 1, xmin - pad, xmax + pad + 1),
+                      (ymin - pad, ymax + pad + 1, xmin - pad, xmin + pad + 1),
+                      (ymin - pad, ymax + pad + 1, xmax - pad, xmax + pad + 1))
+            regions += [(min(max(y0, 0), image_h), min(max(y1, 0), image_h),
+                         min(max(x0, 0), image_w), min(max(x1, 0), image_w)) for y0, y1, x0, x1 in strips]
+        return regions
+
+    def _draw(self, image, layout):
+        image_h, image_w = image.shape[:2]
+        for (xmin, ymin, xmax, ymax), colour, sprite in layout:
+            cv2.rectangle(image, (xmin, ymin), (xmax, ymax), colour, self.line_width)
+            if sprite is not None:
+                mask, offset = sprite
+                top = ymin - offset
+                # blit the cached white caption, clipped to the image
+                y0, x0 = max(top, 0), max(xmin, 0)
+                y1, x1 = min(top + mask.shape[0], image_h), min(xmin + mask.shape[1], image_w)
+                if y0 < y1 and x0 < x1:
+                    region = image[y0:y1, x0:x1]
+                    np.maximum(region, mask[y0 - top:y1 - top, x0 - xmin:x1 - xmin], out=region)
+
+    def draw(self, image, detections):
+        """Draw the detections onto image, in place"""
+        image_h, image_w = image.shape[:2]
+        self._draw(image, self.layout(detections, image_w, image_h))
+        return image
+
+    def render(self, frame, detections, frame_id=None):
+        """The frame at `size` with the detections drawn on it (a buffer reused between calls)"""
+        height, width = frame.shape[:2]
+        size = self.size or (width, height)
+
+        if frame_id is None or frame_id != self.frame_id or self.out is None:
+            # a new frame: scaled straight into the output buffer
+            if self.out is None or self.out.shape[:2] != (size[1], size[0]):
+                self.out = np.empty((size[1], size[0], 3), dtype=np.uint8)
+            if size == (width, height):
+                self.out[...] = frame
+            else:
+                cv2.resize(frame, size, dst=self.out, interpolation=cv2.INTER_LINEAR)
+        else:
+            boxes = (detections.coords.tobytes(), detections.labels.tobytes(), detections.scores.tobytes())
+            if boxes == self.drawn:
+                # same frame, same boxes: the output is already right
+                return self.out
+            # same frame, new boxes: put back what the old boxes covered
+            for (y0, y1, x0, x1), pixels in reversed(self.saved):
+                self.out[y0:y1, x0:x1] = pixels
+
+        layout = self.layout(detections, size[0], size[1])
+        self.saved = [((y0, y1, x0, x1), self.out[y0:y1, x0:x1].copy())
+                      for y0, y1, x0, x1 in self.regions(layout, size[0], size[1])]
+        self._draw(self.out, layout)
+        self.frame_id = frame_id
+        self.drawn = (detections.coords.tobytes(), detections.labels.tobytes(), detections.scores.tobytes())
+        return self.out
+
+
+# renderers of draw_boxes, by label list, so the styles and sprites are kept between calls
+_renderers = {}
+
+
+def draw_boxes(image, detections, labels):
+    """Rasterise detections onto an RGB image"""
+    start = time.time()
+    renderer = _renderers.get(tuple(labels))
+    if renderer is None:
+        renderer = _renderers[tuple(labels)] = BoxRenderer(labels)
+    renderer.draw(image, detections)
+    METRICS.record('draw_boxes', time.time() - start)
     return image
 
 
 def decode_netout(netout, anchors, nb_class, obj_threshold=0.3, nms_threshold=0.3):
+    """
+    Decode a (grid_h, grid_w, nb_box, 4 + 1 + nb_class) network output into Detections.
+    The whole tensor is decoded at once; only the candidates that survive the
+    objectness threshold are turned into boxes and passed through class-wise NMS.
+    The input array is left untouched.
+    """
     grid_h, grid_w, nb_box = netout.shape[:3]
 
-    boxes = []
-
     # decode the output by the network
-    netout[..., 4] = _sigmoid(netout[..., 4])
-    netout[..., 5:] = netout[..., 4][..., np.newaxis] * \
-        _softmax(netout[..., 5:])
-    netout[..., 5:] *= netout[..., 5:] > obj_threshold
-
-    for row in range(grid_h):
-        for col in range(grid_w):
-            for b in range(nb_box):
-                # from 4th element onwards are confidence and class classes
-                classes = netout[row, col, b, 5:]
-
-                if np.sum(classes) > 0:
-                    # first 4 elements are x, y, w, and h
-                    x, y, w, h = netout[row, col, b, :4]
-
-                    # center position, unit: image width
-                    x = (col + _sigmoid(x)) / grid_w
-                    # center position, unit: image height
-                    y = (row + _sigmoid(y)) / grid_h
-                    w = anchors[2 * b + 0] * \
-                        np.exp(w) / grid_w  # unit: image width
-                    h = anchors[2 * b + 1] * \
-                        np.exp(h) / grid_h  # unit: image height
-                    confidence = netout[row, col, b, 4]
-
-                    box = BoundBox(x-w/2, y-h/2, x+w/2, y +
-                                   h/2, confidence, classes)
-
-                    boxes.append(box)
-
-    # suppress non-maximal boxes
+    confidence = _sigmoid(netout[..., 4])
+    classes = confidence[..., np.newaxis] * _softmax(netout[..., 5:])
+    classes *= classes > obj_threshold
+
+    # keep the cells/anchors where any class survived the threshold
+    # (nonzero walks the grid in the same row, col, anchor order as a nested loop)
+    rows, cols, anchor_ids = np.nonzero(classes.sum(axis=-1) > 0)
+
+    if len(rows) == 0:
+        return Detections.empty(classes.shape[-1])
+
+    classes = classes[rows, cols, anchor_ids]
+    confidence = confidence[rows, cols, anchor_ids]
+    x, y, w, h = netout[rows, cols, anchor_ids, :4].T
+
+    anchors = np.asarray(anchors, dtype=np.float32).reshape(-1, 2)
+
+    # center position, unit: image width/height
+    x = (cols + _sigmoid(x)) / grid_w
+    y = (rows + _sigmoid(y)) / grid_h
+    # box size, unit: image width/height
+    w = anchors[anchor_ids, 0] * np.exp(w) / grid_w
+    h = anchors[anchor_ids, 1] * np.exp(h) / grid_h
+
+    coords = np.stack([x - w/2, y - h/2, x + w/2, y + h/2], axis=1)
+
+    # suppress non-maximal boxes, class by class
+    overlaps = compute_overlap(coords, coords)
+
     for c in range(nb_class):
-        sorted_indices = list(
-            reversed(np.argsort([box.classes[c] for box in boxes])))
+        sorted_indices = np.argsort(classes[:, c])[::-1]
+        sorted_indices = sorted_indices[classes[sorted_indices, c] > 0]
+        class_overlaps = overlaps[np.ix_(sorted_indices, sorted_indices)]
 
+        alive = np.ones(len(sorted_indices), dtype=bool)
         for i in range(len(sorted_indices)):
-            index_i = sorted_indices[i]
-
-            if boxes[index_i].classes[c] == 0:
-                continue
-            else:
-                for j in range(i+1, len(sorted_indices)):
-                    index_j = sorted_indices[j]
+            if alive[i]:
+                alive[i+1:] &= class_overlaps[i, i+1:] < nms_threshold
 
-                    if bbox_iou(boxes[index_i], boxes[index_j]) >= nms_threshold:
-                        boxes[index_j].classes[c] = 0
+        classes[sorted_indices[~alive], c] = 0
 
     # remove the boxes which are less likely than a obj_threshold
-    boxes = [box for box in boxes if box.get_score() > obj_threshold]
+    labels = np.argmax(classes, axis=-1)
+    scores = classes[np.arange(len(labels)), labels]
+    keep = scores > obj_threshold
 
-    return boxes
+    return Detections(coords[keep], scores[keep], labels[keep],
+                      confidence[keep], classes[keep])
 
 
 def compute_overlap(a, b):
@@ -194,8 +379,8 @@ def compute_ap(recall, precision):
     mpre = np.concatenate(([0.], precision, [0.]))
 
     # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # (running maximum taken from the right)
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -241,3 +426,53 @@ def _softmax(x, axis=-1, t=-100.):
         x = x/np.min(x)*t
     e_x = np.exp(x)
     return e_x / e_x.sum(axis, keepdims=True)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    labels = ["can", "bottle", "ken", "grace", "frank", "tim", "shelly"]
+    frame = np.random.randint(0, 256, (224, 224, 3), dtype=np.uint8)
+    display_size = (1180, 1180)
+    rng = np.random.RandomState(0)
+
+    def old_draw_boxes(image, detections):
+        # the per-box style lookup and text rasterisation this replaced
+        image_h, image_w, _ = image.shape
+        for box in detections:
+            xmin, ymin = int(box.xmin * image_w), int(box.ymin * image_h)
+            xmax, ymax = int(box.xmax * image_w), int(box.ymax * image_h)
+            colour, caption = box_style(labels[box.get_label()], box.get_score())
+            cv2.rectangle(image, (xmin, ymin), (xmax, ymax), colour, 2)
+            if caption is not None:
+                cv2.putText(image, caption, (xmin, ymin - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+        return image
+
+    print("{:>5} {:>12} {:>12} | at {}x{}: {:>12} {:>12} {:>12}".format(
+        'boxes', 'old draw', 'draw_boxes', display_size[0], display_size[1],
+        'draw+resize', 'render', 'same frame'))
+    for n in (1, 10, 50):
+        xy = rng.uniform(0, 0.7, (n, 2)).astype(np.float32)
+        coords = np.concatenate([xy, xy + rng.uniform(0.1, 0.3, (n, 2)).astype(np.float32)], axis=1)
+        boxes = Detections(coords, rng.uniform(0.5, 1., n).astype(np.float32), rng.randint(0, len(labels), n))
+        moved = Detections(coords + 0.01, boxes.scores, boxes.labels)
+        renderer = BoxRenderer(labels, size=display_size)
+        image = frame.copy()
+
+        def old_display():
+            return cv2.resize(old_draw_boxes(frame.copy(), boxes), display_size)
+
+        def new_frame():
+            return renderer.render(frame, boxes)
+
+        def new_boxes():
+            # alternating boxes over one frame: only their regions are redrawn
+            renderer.render(frame, boxes, frame_id=0)
+            return renderer.render(frame, moved, frame_id=0)
+
+        number = 200
+        times = [min(timeit.repeat(fn, number=number, repeat=3)) / number * 1000
+                 for fn in (lambda: old_draw_boxes(image, boxes), lambda: draw_boxes(image, boxes, labels),
+                            old_display, new_frame)]
+        times.append(min(timeit.repeat(new_boxes, number=number, repeat=3)) / number / 2 * 1000)
+        print("{:>5} {:>9.3f} ms {:>9.3f} ms | {:>19.3f} ms {:>9.3f} ms {:>9.3f} ms".format(n, *times))
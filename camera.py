@@ -1,49 +1,371 @@
-from picamera.array import PiRGBArray
-from picamera import PiCamera
+'''
+Frame sources for the computer vision pipeline.
+Every source delivers RGB frames (the model's colour order) through the same
+preallocated triple buffer and blocking read_latest() API:
+  1. PiVideoStream:     the connected PiCamera
+  2. ImageFolderSource: a directory of images, replayed in name order
+  3. VideoFileSource:   a video file
+  4. SyntheticSource:   generated frames with a bouncing square
+The replay sources run at a fixed framerate, or unthrottled with framerate=None,
+so the pipeline can be exercised and profiled without a Raspberry Pi.
+Use open_source() to build one from a short description, e.g. "video:clip.mp4".
+
+Running this script measures end-to-end throughput and capture-to-display latency:
+  python3 camera.py --source synthetic --model synthetic
+'''
+
+import os
+import time
+from threading import Thread, Condition
+
 import cv2
 import numpy as np
-from threading import Thread
+
+from metrics import METRICS
 
 cv2.setUseOptimized(True)
 
 
-class PiVideoStream:
-    def __init__(self, resolution=(320, 240), framerate=32):
-        # initialize the camera and stream
+class FrameSource:
+    """
+    Base class for frame sources: a preallocated triple buffer of frames.
+    The producer fills the spare buffer through _publish() and then swaps it in
+    as the latest one under a lock, so capture never allocates and never touches
+    the buffer consumers are copying from.
+    Consumers call read_latest() to block for a fresh frame, and get their own
+    consistent copy of the (optionally cropped) frame.
+    """
+
+    def __init__(self, resolution, crop=None):
+        width, height = resolution
+        self.resolution = resolution
+        self.crop = crop
+        self.buffers = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(3)]
+        self.write_index = 0
+        self.latest_index = None
+
+        # every captured frame gets a sequence number and timestamp,
+        # consumers wait on new_frame instead of polling
+        self.frame_seq = -1
+        self.frame_time = None
+        self.new_frame = Condition()
+        self.delivered = 0
+        self.dropped = 0
+        self.partial = 0
+        # optional worker.SharedFrameRing to publish cropped frames into
+        self.ring = None
+        self.stopped = False
+
+    def _publish(self, frame):
+        """Copy (resizing if needed) a frame into the spare buffer and swap it in as the latest"""
+        start = time.time()
+        back = self.buffers[self.write_index]
+        if frame.shape == back.shape:
+            back[...] = frame
+        else:
+            cv2.resize(frame, self.resolution, dst=back)
+
+        with self.new_frame:
+            self.latest_index = self.write_index
+            # write next into the buffer that is neither the latest nor just written
+            self.write_index = (self.write_index + 1) % 3
+            self.frame_seq += 1
+            self.frame_time = time.time()
+            self.new_frame.notify_all()
+        METRICS.record('capture', self.frame_time - start, self.frame_time)
+
+        if self.ring is not None:
+            self.ring.write(self._cropped(back), self.frame_time)
+
+    def _cropped(self, frame):
+        return frame if self.crop is None else frame[self.crop]
+
+    def read(self):
+        """Copy of the latest (cropped) frame, without waiting"""
+        with self.new_frame:
+            return self._cropped(self.buffers[self.latest_index]).copy()
+
+    def read_latest(self, newer_than=-1, timeout=None, out=None):
+        """
+        Block until a frame with a sequence number above newer_than exists.
+        Returns (seq, timestamp, frame), or None on timeout.
+        The (cropped) frame is copied into out (allocated if not given) while the
+        buffers cannot be swapped, so it is always one complete frame.
+        """
+        with self.new_frame:
+            if not self.new_frame.wait_for(lambda: self.frame_seq > newer_than, timeout):
+                return None
+
+            latest = self._cropped(self.buffers[self.latest_index])
+            if out is None:
+                out = latest.copy()
+            else:
+                out[...] = latest
+
+            if newer_than >= 0:
+                self.dropped += self.frame_seq - newer_than - 1
+            self.delivered += 1
+            return self.frame_seq, self.frame_time, out
+
+    def stats(self):
+        """Frames captured, delivered to read_latest callers, skipped between their reads, and malformed"""
+        return {'captured': self.frame_seq + 1,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'partial': self.partial}
+
+    def stop(self):
+        self.stopped = True
+
+
+class ReplaySource(FrameSource):
+    """
+    A FrameSource fed from a thread replaying the frames yielded by frames().
+    framerate: frames per second, or None to replay as fast as possible
+    loop:      start again from the first frame once frames() is exhausted
+    """
+
+    def __init__(self, resolution=(224, 224), framerate=20, loop=True):
+        FrameSource.__init__(self, resolution)
+        self.framerate = framerate
+        self.loop = loop
+        self.finished = False
+
+    def frames(self):
+        raise NotImplementedError
+
+    def start(self):
+        # start the thread to replay frames
+        Thread(target=self.update, args=()).start()
+        return self
+
+    def update(self):
+        next_time = time.time()
+        while not self.stopped:
+            published = False
+            for frame in self.frames():
+                if self.stopped:
+                    return
+                if self.framerate:
+                    next_time += 1. / self.framerate
+                    time.sleep(max(next_time - time.time(), 0))
+                self._publish(frame)
+                published = True
+            # a pass without frames would be repeated in a busy loop
+            if not self.loop or not published:
+                break
+        self.finished = True
+
+
+class PiVideoStream(FrameSource):
+    """
+    Streams frames from the connected PiCamera.
+    The camera ISP does the cropping, scaling and colour conversion: zoom selects the
+    region of interest (x, y, w, h as fractions of the sensor) and frames are captured
+    in RGB at exactly resolution, so they need no crop or colour conversion downstream.
+    The default zoom is the centre 224x224 window of the old 320x240 capture.
+    """
+
+    def __init__(self, resolution=(224, 224), framerate=32, zoom=(0.15, 0., 0.7, 0.9333), crop=None):
+        from picamera import PiCamera
+
+        FrameSource.__init__(self, resolution, crop)
+        # initialize the camera; raw frames arrive through write() below
         self.camera = PiCamera()
         self.camera.resolution = resolution
         self.camera.framerate = framerate
+        self.camera.zoom = zoom
         self.camera.vflip = True
         self.camera.hflip = True
-        self.rawCapture = PiRGBArray(self.camera, size=resolution)
-        self.stream = self.camera.capture_continuous(
-            self.rawCapture, format="bgr", use_video_port=True)
-        # initialize the frame and the variable used to indicate
-        # if the thread should be stopped
-        self.frame = None
-        self.stopped = False
+
+        # raw frames are padded to a width multiple of 32 and a height multiple of 16
+        width, height = resolution
+        self.padded_shape = ((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3)
+        self.frame_bytes = int(np.prod(self.padded_shape))
 
     def start(self):
-        """Start a new thread to stream frames from connected PiCamera"""
-        Thread(target=self.update, args=()).start()
+        """Start streaming frames from connected PiCamera (on picamera's own thread)"""
+        self.camera.start_recording(self, format='rgb')
         return self
 
-    def update(self):
-        # keep looping infinitely until the thread is stopped
-        for f in self.stream:
-            # grab the frame from the stream and clear the stream in
-            # preparation for the next frame
-            self.frame = f.array
-            self.rawCapture.truncate(0)
-
-            if self.stopped:
-                self.stream.close()
-                self.rawCapture.close()
-                self.camera.close()
-                return
+    def write(self, buf):
+        """picamera custom output: called with exactly one raw RGB frame per call"""
+        if len(buf) != self.frame_bytes:
+            self.partial += 1
+            return
+        width, height = self.resolution
+        frame = np.frombuffer(buf, dtype=np.uint8).reshape(self.padded_shape)
+        self._publish(frame[:height, :width])
 
-    def read(self):
-        return self.frame[0:224, 48:272, :]  # crop the frame
+    def flush(self):
+        pass
 
     def stop(self):
-        self.stopped = True
+        if not self.stopped:
+            self.stopped = True
+            self.camera.stop_recording()
+            self.camera.close()
+
+
+class ImageFolderSource(ReplaySource):
+    """Replays the images in a directory, in name order"""
+
+    def __init__(self, folder, resolution=(224, 224), framerate=20, loop=True):
+        ReplaySource.__init__(self, resolution, framerate, loop)
+        self.paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                      if name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp'))]
+        if not self.paths:
+            raise ValueError("No images found in " + folder)
+
+    def frames(self):
+        for path in self.paths:
+            image = cv2.imread(path)
+            if image is not None:
+                yield cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class VideoFileSource(ReplaySource):
+    """Replays a video file (anything cv2.VideoCapture can open)"""
+
+    def __init__(self, path, resolution=(224, 224), framerate=20, loop=True):
+        ReplaySource.__init__(self, resolution, framerate, loop)
+        self.path = path
+        # fail here rather than on the replay thread, where nobody would see it
+        capture = cv2.VideoCapture(path)
+        try:
+            if not capture.isOpened():
+                raise ValueError("Cannot open video " + path)
+            if not capture.read()[0]:
+                raise ValueError("No frames found in " + path)
+        finally:
+            capture.release()
+
+    def frames(self):
+        capture = cv2.VideoCapture(self.path)
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+
+
+class SyntheticSource(ReplaySource):
+    """Generates frames with a square bouncing across a plain background"""
+
+    def __init__(self, resolution=(224, 224), framerate=20, loop=True, nb_frames=200):
+        ReplaySource.__init__(self, resolution, framerate, loop)
+        self.nb_frames = nb_frames
+
+    def frames(self):
+        width, height = self.resolution
+        size = min(width, height) // 4
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+
+        for i in range(self.nb_frames):
+            frame[...] = 30
+            x = int((width - size) * abs((i * 0.02) % 2 - 1))
+            y = int((height - size) * abs((i * 0.013) % 2 - 1))
+            frame[y:y + size, x:x + size] = (40, 200, 60)
+            yield frame
+
+
+def open_source(spec, **kwargs):
+    """
+    Build a frame source from a short description:
+      "picamera", "synthetic", "images:<folder>" or "video:<path>"
+    Keyword arguments are passed to the source (e.g. framerate=None for unthrottled replay).
+    """
+    kind, _, path = spec.partition(':')
+    if kind == 'picamera':
+        return PiVideoStream(**kwargs)
+    if kind == 'synthetic':
+        return SyntheticSource(**kwargs)
+    if kind == 'images':
+        return ImageFolderSource(path, **kwargs)
+    if kind == 'video':
+        return VideoFileSource(path, **kwargs)
+    raise ValueError("Unknown frame source: " + spec)
+
+
+def benchmark_pipeline(source, pred, duration=10., interval=0.06):
+    """
+    Run a MainView.tick-like display loop over a started source and inference loop.
+    Returns display fps, inference throughput, and latencies (seconds) from capture
+    of the displayed frame to its display, and from capture of the frame behind the
+    displayed detections to its display.
+    """
+    from box_utils import BoxRenderer
+
+    renderer = BoxRenderer([str(i) for i in range(64)])
+    display_latency, detection_latency = [], []
+    seq = -1
+    start = time.time()
+    inferences_before = pred.report()['inferences']
+
+    while time.time() - start < duration:
+        tick_start = time.time()
+        latest = source.read_latest(newer_than=seq, timeout=1.)
+        if latest is None:
+            continue
+        seq, frame_time, frame = latest
+
+        detection_time, boxes = pred.read_timed()
+        image = renderer.render(frame, boxes, frame_id=seq)
+        cv2.flip(image, 0)
+
+        shown = time.time()
+        display_latency.append(shown - frame_time)
+        if detection_time is not None:
+            detection_latency.append(shown - detection_time)
+        time.sleep(max(interval - (time.time() - tick_start), 0))
+
+    elapsed = time.time() - start
+    inferences = pred.report()['inferences'] - inferences_before
+
+    return {'display_fps': len(display_latency) / elapsed,
+            'inference_fps': inferences / elapsed,
+            'display_latency_p50': float(np.percentile(display_latency, 50)),
+            'display_latency_p95': float(np.percentile(display_latency, 95)),
+            'detection_latency_p50': float(np.percentile(detection_latency, 50)) if detection_latency else 0.,
+            'detection_latency_p95': float(np.percentile(detection_latency, 95)) if detection_latency else 0.}
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Measure pipeline throughput and latency on a frame source')
+    parser.add_argument('--source', default='synthetic', help='picamera, synthetic, images:<folder> or video:<path>')
+    parser.add_argument('--framerate', type=float, default=20, help='replay rate, 0 for unthrottled')
+    parser.add_argument('--model', choices=['synthetic', 'keras'], default='synthetic')
+    parser.add_argument('--synthetic-seconds', type=float, default=0.5)
+    parser.add_argument('--config', default='data/config.json')
+    parser.add_argument('--weights', default='data/best_weights_11.h5')
+    parser.add_argument('--duration', type=float, default=10.)
+    args = parser.parse_args()
+
+    from inference import InferenceLoop
+
+    if args.model == 'synthetic':
+        from worker import _SyntheticModel
+        with open(args.config) as config_buffer:
+            model = _SyntheticModel(args.synthetic_seconds, len(json.load(config_buffer)['model']['labels']))
+    else:
+        import model_cache
+        model = model_cache.load_model(args.config, args.weights)
+
+    source = open_source(args.source) if args.source == 'picamera' else \
+        open_source(args.source, framerate=args.framerate or None)
+    source.start()
+    pred = InferenceLoop(model, source, log_interval=0).start()
+
+    report = benchmark_pipeline(source, pred, args.duration)
+    pred.stop()
+    source.stop()
+
+    for key in sorted(report):
+        print("{:<22} {:.3f}".format(key, report[key]))
+    print("source", source.stats())
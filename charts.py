@@ -0,0 +1,220 @@
+'''
+Recycling statistics charts for the kiosk's InfoView.
+  1. ChartService: a background thread that reads the stats (iot.firebase_stats, from the
+     event log's aggregates or Firebase) and renders the by-user and by-category bar charts
+     with matplotlib's Agg canvas, imported only when the first chart is drawn. Each chart
+     is keyed on a hash of its numbers: it is only redrawn when they change, and rendered
+     charts are kept as PNGs in the cache folder, so a restart with the same numbers
+     loads them instead of drawing them again
+  2. ChartDisplay: shows the service's latest charts in Image widgets, uploading a texture
+     only for a chart whose key changed
+Nothing is drawn on the UI thread, so switching to the InfoView never blocks the camera view.
+
+Running this script times a first render, a redraw, a PNG cache hit and an unchanged refresh.
+'''
+
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from threading import Thread, Event, Lock
+
+import numpy as np
+
+import iot
+from metrics import METRICS
+
+# pixels: RGBA, (height, width, 4) uint8, top row first
+Chart = namedtuple('Chart', ['name', 'key', 'pixels'])
+
+# chart name: (title, x axis label), drawn from firebase_stats' (by user, by category)
+CHARTS = {'by_user': ('Statistics by user', 'User name'),
+          'by_category': ('Statistics by category', 'Recyclable item category')}
+
+
+def chart_key(name, counts):
+    """Hash of a chart and its numbers; equal keys draw equal charts"""
+    data = json.dumps([name, sorted(counts.items())])
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+def render_bar_chart(counts, title, xlabel, ylabel='Number of items recycled', size=(4., 3.), dpi=100):
+    """Draw a bar chart of {name: count} off-screen; returns its RGBA pixels"""
+    # the Agg canvas directly, not pyplot: no GUI backend, no global figure state
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=size, dpi=dpi)
+    canvas = FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    axes.bar(range(len(counts)), list(counts.values()))
+    axes.set_xticks(range(len(counts)))
+    axes.set_xticklabels(list(counts.keys()))
+    axes.set_title(title)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    figure.tight_layout()
+    canvas.draw()
+    return np.array(canvas.buffer_rgba(), dtype=np.uint8)
+
+
+class ChartService:
+    """
+    Keeps the latest charts of a stats source (an EventLog or a firebase reference).
+    The thread checks the stats every `interval` seconds, or right away after refresh().
+    """
+
+    def __init__(self, source, cache_dir="data/cache/charts", interval=10., size=(4., 3.), dpi=100,
+                 keep=10):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.interval = interval
+        self.size = size
+        self.dpi = dpi
+        self.keep = keep
+        self.charts = {}
+        self.lock = Lock()
+        self.wake = Event()
+        self.stopped = False
+        self.renders = 0
+        self.loads = 0
+        self.thread = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def start(self):
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def refresh(self):
+        """Check the stats now, without waiting for the interval (does not block)"""
+        self.wake.set()
+
+    def latest(self):
+        """{name: Chart} of the charts drawn so far"""
+        with self.lock:
+            return dict(self.charts)
+
+    def update(self):
+        while not self.stopped:
+            try:
+                self.check()
+            except Exception as error:
+                print("[!] Chart update failed:", error)
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def check(self):
+        """Redraw the charts whose numbers changed; returns the names of those that did"""
+        by_user_count, by_category_count = iot.firebase_stats(self.source)
+        changed = []
+        for name, counts in (('by_user', by_user_count), ('by_category', by_category_count)):
+            key = chart_key(name, counts)
+            current = self.charts.get(name)
+            if current is not None and current.key == key:
+                continue
+            chart = Chart(name, key, self.draw(name, key, counts))
+            with self.lock:
+                self.charts[name] = chart
+            changed.append(name)
+        return changed
+
+    def draw(self, name, key, counts):
+        """The chart's pixels, from the PNG cache or freshly rendered into it"""
+        from matplotlib import image
+
+        path = os.path.join(self.cache_dir, "{}-{}.png".format(name, key))
+        if os.path.isfile(path):
+            try:
+                # PNGs are read back as floats in [0, 1]
+                pixels = (image.imread(path) * 255).round().astype(np.uint8)
+                self.loads += 1
+                return pixels
+            except Exception as error:
+                print("[!] Cached chart unreadable, drawing it again:", error)
+                os.remove(path)
+
+        title, xlabel = CHARTS[name]
+        with METRICS.time('chart_render'):
+            pixels = render_bar_chart(counts, title, xlabel, size=self.size, dpi=self.dpi)
+        # write then rename, so a crash mid-write never leaves a truncated PNG in the cache
+        partial = path + '.partial'
+        image.imsave(partial, pixels, format='png')
+        os.replace(partial, path)
+        self.renders += 1
+        self.prune(name)
+        return pixels
+
+    def prune(self, name):
+        """Keep the `keep` newest PNGs of a chart"""
+        paths = [os.path.join(self.cache_dir, filename) for filename in os.listdir(self.cache_dir)
+                 if filename.startswith(name + '-') and filename.endswith('.png')]
+        for path in sorted(paths, key=os.path.getmtime)[:-self.keep]:
+            os.remove(path)
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class ChartDisplay:
+    """Shows a ChartService's charts in Image widgets ({chart name: widget})"""
+
+    def __init__(self, service, widgets):
+        self.service = service
+        self.widgets = widgets
+        self.keys = {}
+
+    def update(self, dt=None):
+        """Upload the charts that changed since the last call; cheap when none did"""
+        from kivy.graphics.texture import Texture
+
+        for name, chart in self.service.latest().items():
+            if name not in self.widgets or self.keys.get(name) == chart.key:
+                continue
+            height, width = chart.pixels.shape[:2]
+            start = time.time()
+            texture = Texture.create(size=(width, height), colorfmt='rgba')
+            # numpy rows run top to bottom, texture rows bottom to top
+            texture.flip_vertical()
+            texture.blit_buffer(chart.pixels.reshape(-1), colorfmt='rgba', bufferfmt='ubyte')
+            self.widgets[name].texture = texture
+            METRICS.record('chart_upload', time.time() - start)
+            self.keys[name] = chart.key
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    from event_log import EventLog
+
+    directory = tempfile.mkdtemp()
+    log = EventLog(os.path.join(directory, 'events.db'))
+    iot.firebase_random(log)
+    log.flush()
+
+    def timed(function):
+        start = time.time()
+        function()
+        return (time.time() - start) * 1000
+
+    service = ChartService(log, cache_dir=os.path.join(directory, 'charts'))
+    print("first render (with imports) {:7.1f} ms".format(timed(service.check)))
+    log.append('ken', 'cans')
+    log.flush()
+    print("redraw, numbers changed     {:7.1f} ms".format(timed(service.check)))
+    print("refresh, nothing changed    {:7.1f} ms".format(timed(service.check)))
+    print("{} renders".format(service.renders))
+
+    # a restart with the same numbers: the charts come from the PNG cache
+    service = ChartService(log, cache_dir=os.path.join(directory, 'charts'))
+    print("restart, PNG cache hit      {:7.1f} ms".format(timed(service.check)))
+    print("{} renders, {} PNG loads".format(service.renders, service.loads))
+
+    log.close()
+    shutil.rmtree(directory)
@@ -0,0 +1,130 @@
+'''
+Display path for the camera view in MainView.
+  1. CameraDisplay: uploads each new frame into one persistent texture, allocated once;
+     the vertical flip and the upscale to the widget size are done by the GPU
+  2. BoxOverlay: draws detections as Kivy canvas instructions over the camera view,
+     instead of rasterising them into the frame
+Running this script compares the CPU work of the old per-tick path (colour conversion,
+drawing, flip, upscale and copy on the CPU) with the new one, without needing a window.
+'''
+
+import time
+
+import numpy as np
+
+from box_utils import box_style
+from metrics import METRICS
+
+
+class CameraDisplay:
+    """Keeps an Image widget showing the latest frame of a frame source"""
+
+    def __init__(self, widget, frame_shape, colorfmt='rgb'):
+        from kivy.graphics.texture import Texture
+
+        height, width = frame_shape[:2]
+        self.widget = widget
+        self.colorfmt = colorfmt
+        self.texture = Texture.create(size=(width, height), colorfmt=colorfmt)
+        self.texture.mag_filter = 'linear'
+        # numpy rows run top to bottom, texture rows bottom to top
+        self.texture.flip_vertical()
+        self.buffer = np.zeros(frame_shape, dtype=np.uint8)
+        self.seq = -1
+        self.frame_time = None
+        widget.texture = self.texture
+
+    def update(self, source):
+        """Upload the source's latest frame if there is a new one; returns whether there was"""
+        latest = source.read_latest(newer_than=self.seq, timeout=0, out=self.buffer)
+        if latest is None:
+            return False
+
+        self.seq, self.frame_time, _ = latest
+        start = time.time()
+        self.texture.blit_buffer(self.buffer.reshape(-1), colorfmt=self.colorfmt, bufferfmt='ubyte')
+        self.widget.canvas.ask_update()
+        end = time.time()
+        METRICS.record('texture_upload', end - start, end)
+        # capture to upload: how old the frame on screen is
+        METRICS.record('frame_age', end - self.frame_time, end)
+        return True
+
+
+class BoxOverlay:
+    """Draws detections over an Image widget, styled like box_utils.draw_boxes"""
+
+    def __init__(self, widget, labels, line_width=2, font_size=16):
+        from kivy.graphics import InstructionGroup
+
+        self.widget = widget
+        self.labels = labels
+        self.line_width = line_width
+        self.font_size = font_size
+        self.group = InstructionGroup()
+        self.captions = {}
+        widget.canvas.after.add(self.group)
+
+    def _caption(self, text):
+        """Rendered caption texture, cached by text"""
+        if text not in self.captions:
+            from kivy.core.text import Label as CoreLabel
+            label = CoreLabel(text=text, font_size=self.font_size)
+            label.refresh()
+            self.captions[text] = label.texture
+        return self.captions[text]
+
+    def update(self, detections):
+        from kivy.graphics import Color, Line, Rectangle
+
+        # area of the widget the (aspect-preserved) image is drawn in
+        width, height = self.widget.norm_image_size
+        left = self.widget.center_x - width / 2.
+        bottom = self.widget.center_y - height / 2.
+
+        start = time.time()
+        self.group.clear()
+        for (xmin, ymin, xmax, ymax), label_id, score in zip(detections.coords.tolist(),
+                                                             detections.labels.tolist(),
+                                                             detections.scores.tolist()):
+            colour, caption = box_style(self.labels[label_id], score)
+            # image y runs downwards, widget y upwards
+            x, y = left + xmin * width, bottom + (1. - ymax) * height
+            w, h = (xmax - xmin) * width, (ymax - ymin) * height
+
+            self.group.add(Color(colour[0] / 255., colour[1] / 255., colour[2] / 255.))
+            self.group.add(Line(rectangle=(x, y, w, h), width=self.line_width))
+            if caption is not None:
+                texture = self._caption(caption)
+                self.group.add(Color(1, 1, 1))
+                self.group.add(Rectangle(texture=texture, size=texture.size, pos=(x, y + h + 2)))
+        METRICS.record('overlay', time.time() - start)
+
+
+if __name__ == '__main__':
+    import timeit
+    import cv2
+    from box_utils import Detections, draw_boxes
+
+    labels = ["can", "bottle", "ken", "grace", "frank", "tim", "shelly"]
+    frame = np.random.randint(0, 256, (224, 224, 3), dtype=np.uint8)
+    buffer = np.zeros_like(frame)
+    boxes = Detections(np.array([[0.1, 0.1, 0.4, 0.5], [0.5, 0.2, 0.9, 0.8]], dtype=np.float32),
+                       np.array([0.9, 0.5], dtype=np.float32), np.array([0, 3]))
+
+    def old_tick():
+        # the old path also converted the BGR capture for display
+        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        image = draw_boxes(image, boxes, labels)
+        image = cv2.resize(cv2.flip(image, 0), (1180, 1180))
+        return image.tobytes()
+
+    def new_tick():
+        # the frame is copied once into the persistent upload buffer; everything else is on the GPU
+        buffer[...] = frame
+        return buffer.reshape(-1)
+
+    number = 100
+    for name, fn in [('old tick', old_tick), ('new tick', new_tick)]:
+        best = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        print("{:<9} {:.3f} ms CPU per tick (excluding texture upload)".format(name, best * 1000))
@@ -0,0 +1,269 @@
+'''
+Inference engines behind ObjectDetection.
+An engine takes a preprocessed float32 batch of shape (batch, size, size, 3)
+and returns the raw network output, one (grid_h, grid_w, nb_box, ...) tensor per image.
+  1. KerasEngine:  the full Keras/TensorFlow model
+  2. TFLiteEngine: an exported (optionally float16/int8 quantized) TensorFlow Lite model,
+                   run on tflite_runtime when installed, otherwise on TensorFlow's interpreter
+
+Running this script exports a model, checks an exported model against Keras,
+or benchmarks one engine (run it once per engine to compare FPS and memory):
+  python3 engines.py export --quantize int8 --output data/detector_int8.tflite
+  python3 engines.py check --tflite data/detector_int8.tflite --images captures/
+  python3 engines.py bench --tflite data/detector_int8.tflite
+'''
+
+import time
+
+import numpy as np
+
+from box_utils import compute_overlap
+
+
+class KerasEngine:
+    """Runs the Keras model, feeding it the zeroed training-only true_boxes input"""
+
+    def __init__(self, model, max_box_per_image):
+        self.model = model
+        self.max_box_per_image = max_box_per_image
+        self.output_shape = model.output_shape
+        self._dummy_arrays = {}
+
+    def predict(self, input_image):
+        batch_size = len(input_image)
+        if batch_size not in self._dummy_arrays:
+            self._dummy_arrays[batch_size] = np.zeros(
+                (batch_size, 1, 1, 1, self.max_box_per_image, 4), dtype='float32')
+
+        return self.model.predict([input_image, self._dummy_arrays[batch_size]], batch_size=batch_size)
+
+
+class TFLiteEngine:
+    """Runs an exported TensorFlow Lite model (see export_tflite)"""
+
+    def __init__(self, model_path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        if num_threads is None:
+            self.interpreter = Interpreter(model_path=model_path)
+        else:
+            self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.output_shape = tuple(self.output_details['shape'])
+        self.batch_size = self.input_details['shape'][0]
+
+    def _resize(self, batch_size):
+        shape = list(self.input_details['shape'])
+        shape[0] = batch_size
+        self.interpreter.resize_tensor_input(self.input_details['index'], shape)
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def predict(self, input_image):
+        if len(input_image) != self.batch_size:
+            self._resize(len(input_image))
+
+        # fully quantized models take/return integers; convert at the boundary
+        input_dtype = self.input_details['dtype']
+        if input_dtype != np.float32:
+            scale, zero_point = self.input_details['quantization']
+            input_image = np.round(input_image / scale + zero_point).astype(input_dtype)
+
+        self.interpreter.set_tensor(self.input_details['index'], input_image)
+        self.interpreter.invoke()
+        netouts = self.interpreter.get_tensor(self.output_details['index'])
+
+        if netouts.dtype != np.float32:
+            scale, zero_point = self.output_details['quantization']
+            netouts = (netouts.astype(np.float32) - zero_point) * scale
+
+        return netouts
+
+
+def inference_graph(model):
+    """
+    Strip the training-only true_boxes input and dummy Lambda layer,
+    returning a Keras model from image straight to the reshaped detections.
+    """
+    from keras.models import Model
+
+    dummy_layer = model.layers[-1]
+    return Model(model.inputs[0], dummy_layer.input[0])
+
+
+def export_tflite(model, output_path, quantize=None, representative_images=None):
+    """
+    Export ObjectDetection.model as a TensorFlow Lite flatbuffer.
+    quantize: None (float32), 'float16' (float16 weights), or
+              'int8' (int8 weights and activations, calibrated on representative_images)
+    """
+    import tensorflow as tf
+    from preprocessing import normalize_into
+
+    graph = inference_graph(model)
+
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model'):
+        converter = tf.lite.TFLiteConverter.from_keras_model(graph)
+    else:
+        from keras import backend as K
+        converter = tf.lite.TFLiteConverter.from_session(K.get_session(), graph.inputs, graph.outputs)
+
+    if quantize == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        if not representative_images:
+            raise ValueError("int8 quantization needs representative images for calibration")
+
+        def representative_dataset():
+            for image in representative_images:
+                input_image = np.zeros((1,) + graph.input_shape[1:], dtype=np.float32)
+                normalize_into(image, input_image[0])
+                yield [input_image]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+    elif quantize is not None:
+        raise ValueError("Unknown quantization: " + str(quantize))
+
+    with open(output_path, 'wb') as output_buffer:
+        output_buffer.write(converter.convert())
+
+    return output_path
+
+
+def match_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Greedily match candidate boxes to reference boxes of the same label.
+    Returns (number matched, IoUs of the matches, absolute score differences of the matches).
+    """
+    if len(reference) == 0 or len(candidate) == 0:
+        return 0, [], []
+
+    overlaps = compute_overlap(reference.coords.astype(np.float64), candidate.coords.astype(np.float64))
+    overlaps[reference.labels[:, np.newaxis] != candidate.labels[np.newaxis, :]] = 0
+
+    ious, score_diffs = [], []
+    for i in np.argsort(-reference.scores):
+        j = np.argmax(overlaps[i])
+        if overlaps[i, j] >= iou_threshold:
+            ious.append(overlaps[i, j])
+            score_diffs.append(abs(reference.scores[i] - candidate.scores[j]))
+            overlaps[:, j] = 0
+
+    return len(ious), ious, score_diffs
+
+
+def compare_engines(reference_model, candidate_model, images, iou_threshold=0.5):
+    """Compare the decoded boxes of two ObjectDetection models over a list of images"""
+    nb_reference, nb_candidate, nb_matched = 0, 0, 0
+    ious, score_diffs = [], []
+
+    for image in images:
+        reference = reference_model.predict(image)
+        candidate = candidate_model.predict(image)
+        matched, match_ious, match_diffs = match_detections(reference, candidate, iou_threshold)
+
+        nb_reference += len(reference)
+        nb_candidate += len(candidate)
+        nb_matched += matched
+        ious.extend(match_ious)
+        score_diffs.extend(match_diffs)
+
+    return {'images': len(images),
+            'reference_boxes': nb_reference,
+            'candidate_boxes': nb_candidate,
+            'recall': nb_matched / float(max(nb_reference, 1)),
+            'precision': nb_matched / float(max(nb_candidate, 1)),
+            'mean_iou': float(np.mean(ious)) if ious else 0.,
+            'max_score_diff': float(np.max(score_diffs)) if score_diffs else 0.}
+
+
+def benchmark_engine(model, images, repeats=3):
+    """Frames/sec of ObjectDetection.predict, and peak resident memory in MB"""
+    import resource
+
+    model.predict(images[0])  # warm up
+
+    start = time.time()
+    for _ in range(repeats):
+        for image in images:
+            model.predict(image)
+    elapsed = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    return {'fps': repeats * len(images) / elapsed, 'peak_rss_mb': peak_rss}
+
+
+def _load_images(folder, size, limit):
+    import os
+    import cv2
+
+    images = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+            image = cv2.imread(os.path.join(folder, name))
+            if image is not None:
+                images.append(cv2.cvtColor(cv2.resize(image, (size, size)), cv2.COLOR_BGR2RGB))
+        if len(images) >= limit:
+            break
+    return images
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Export, check and benchmark inference engines')
+    parser.add_argument('command', choices=['export', 'check', 'bench'])
+    parser.add_argument('--config', default='data/config.json')
+    parser.add_argument('--weights', default='data/best_weights_11.h5')
+    parser.add_argument('--tflite', default=None, help='exported model (check/bench); bench uses Keras if omitted')
+    parser.add_argument('--output', default='data/detector.tflite')
+    parser.add_argument('--quantize', choices=['float16', 'int8'], default=None)
+    parser.add_argument('--images', default=None, help='folder of images for calibration/checking')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.config) as config_buffer:
+        config = json.load(config_buffer)['model']
+
+    size = config['input_size']
+    if args.images:
+        images = _load_images(args.images, size, args.limit)
+    else:
+        images = [np.random.randint(0, 256, (size, size, 3), dtype=np.uint8) for _ in range(10)]
+
+    def keras_model():
+        import model_cache
+        return model_cache.load_model(args.config, args.weights)
+
+    def tflite_model():
+        from object_detection_model import ObjectDetection
+        return ObjectDetection.from_engine(TFLiteEngine(args.tflite, args.threads),
+                                           input_size=size,
+                                           labels=config['labels'],
+                                           max_box_per_image=config['max_box_per_image'],
+                                           anchors=config['anchors'])
+
+    if args.command == 'export':
+        export_tflite(keras_model().model, args.output, args.quantize, images)
+        print("[+] Exported", args.output)
+    elif args.command == 'check':
+        report = compare_engines(keras_model(), tflite_model(), images)
+        for key in sorted(report):
+            print("{:<16} {}".format(key, report[key]))
+    else:
+        model = tflite_model() if args.tflite else keras_model()
+        report = benchmark_engine(model, images)
+        print("{}: {:.2f} FPS, peak RSS {:.0f} MB".format(
+            args.tflite or 'keras', report['fps'], report['peak_rss_mb']))
@@ -0,0 +1,185 @@
+'''
+Offline evaluation of the object detection model.
+Reads an annotated image folder (Pascal VOC XML annotations, the same
+train_image_folder/train_annot_folder layout used for training), runs the model
+over it in batches and reports per-class AP and mAP alongside latency
+percentiles and images/sec, so accuracy and speed can be traded off when
+changing thresholds, input size or engines.
+
+  python3 evaluate.py --images captures/ --annotations captures/annotations/
+  python3 evaluate.py --tflite data/detector_int8.tflite --batch-size 4
+'''
+
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+
+from box_utils import compute_overlap, compute_ap
+from inference import InferenceStats
+
+
+def parse_annotation(ann_dir, img_dir, labels):
+    """
+    Returns a list of annotated images, each a dictionary of
+    {'filename', 'width', 'height', 'boxes': (N, 4) array, 'labels': (N,) array}
+    Objects whose name is not in labels are ignored.
+    """
+    images = []
+
+    for ann in sorted(os.listdir(ann_dir)):
+        if not ann.endswith('.xml'):
+            continue
+
+        tree = ET.parse(os.path.join(ann_dir, ann))
+        filename = os.path.join(img_dir, tree.findtext('filename'))
+        width = int(tree.findtext('size/width'))
+        height = int(tree.findtext('size/height'))
+
+        boxes, box_labels = [], []
+        for obj in tree.iter('object'):
+            name = obj.findtext('name')
+            if name not in labels:
+                continue
+            bndbox = obj.find('bndbox')
+            boxes.append([float(bndbox.findtext(key)) for key in ('xmin', 'ymin', 'xmax', 'ymax')])
+            box_labels.append(labels.index(name))
+
+        images.append({'filename': filename,
+                       'width': width,
+                       'height': height,
+                       'boxes': np.array(boxes, dtype=np.float64).reshape(-1, 4),
+                       'labels': np.array(box_labels, dtype=np.intp)})
+
+    return images
+
+
+def average_precisions(all_detections, all_annotations, nb_class, iou_threshold=0.5):
+    """
+    all_detections:  per image, (pixel coords (N, 4), scores (N,), labels (N,))
+    all_annotations: per image, (pixel coords (M, 4), labels (M,))
+    Returns a dictionary of class index -> average precision.
+    """
+    aps = {}
+
+    for label in range(nb_class):
+        scores, true_positives = [], []
+        num_annotations = 0
+
+        for (coords, det_scores, det_labels), (ann_boxes, ann_labels) in zip(all_detections, all_annotations):
+            annotations = ann_boxes[ann_labels == label]
+            mask = det_labels == label
+            detections, det_scores = coords[mask], det_scores[mask]
+            num_annotations += len(annotations)
+
+            # highest scoring detections claim annotations first
+            order = np.argsort(-det_scores)
+            detections, det_scores = detections[order], det_scores[order]
+            scores.extend(det_scores.tolist())
+
+            if len(annotations) == 0:
+                true_positives.extend([0] * len(detections))
+                continue
+            if len(detections) == 0:
+                continue
+
+            overlaps = compute_overlap(detections, annotations)
+            assigned = np.argmax(overlaps, axis=1)
+            max_overlap = overlaps[np.arange(len(detections)), assigned]
+            detected = set()
+            for d in range(len(detections)):
+                if max_overlap[d] >= iou_threshold and assigned[d] not in detected:
+                    true_positives.append(1)
+                    detected.add(assigned[d])
+                else:
+                    true_positives.append(0)
+
+        if num_annotations == 0:
+            aps[label] = 0.
+            continue
+
+        indices = np.argsort(-np.array(scores), kind='mergesort')
+        true_positives = np.array(true_positives, dtype=np.float64)[indices]
+
+        tp = np.cumsum(true_positives)
+        fp = np.cumsum(1. - true_positives)
+
+        recall = tp / num_annotations
+        precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        aps[label] = compute_ap(recall, precision)
+
+    return aps
+
+
+def evaluate(model, annotations, batch_size=1, iou_threshold=0.5):
+    """
+    Run the model over annotated images and return (per-class AP, InferenceStats report).
+    Images are resized to the model input size and converted to RGB, as the camera would capture them.
+    """
+    size = model.input_size
+    stats = InferenceStats(window=len(annotations))
+    all_detections, all_annotations = [], []
+
+    for start in range(0, len(annotations), batch_size):
+        chunk = annotations[start:start + batch_size]
+        frames = [cv2.cvtColor(cv2.resize(cv2.imread(image['filename']), (size, size)), cv2.COLOR_BGR2RGB)
+                  for image in chunk]
+
+        batch_start = time.time()
+        results = model.predict_batch(frames, batch_size)
+        stats.record(len(frames), batch_start, time.time())
+
+        for image, detections in zip(chunk, results):
+            scale = np.array([image['width'], image['height'], image['width'], image['height']])
+            all_detections.append((detections.coords * scale, detections.scores, detections.labels))
+            all_annotations.append((image['boxes'], image['labels']))
+
+    aps = average_precisions(all_detections, all_annotations, model.nb_class, iou_threshold)
+    return aps, stats.report()
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Evaluate detection accuracy and speed')
+    parser.add_argument('--config', default='data/config.json')
+    parser.add_argument('--weights', default='data/best_weights_11.h5')
+    parser.add_argument('--tflite', default=None, help='evaluate an exported TensorFlow Lite model instead')
+    parser.add_argument('--images', default=None, help='defaults to train_image_folder in the config')
+    parser.add_argument('--annotations', default=None, help='defaults to train_annot_folder in the config')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--iou-threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    with open(args.config) as config_buffer:
+        config = json.load(config_buffer)
+
+    labels = config['model']['labels']
+    annotations = parse_annotation(args.annotations or config['train']['train_annot_folder'],
+                                   args.images or config['train']['train_image_folder'],
+                                   labels)
+    print("[i] Evaluating on", len(annotations), "images")
+
+    if args.tflite:
+        from engines import TFLiteEngine
+        from object_detection_model import ObjectDetection
+        model = ObjectDetection.from_engine(TFLiteEngine(args.tflite),
+                                            input_size=config['model']['input_size'],
+                                            labels=labels,
+                                            max_box_per_image=config['model']['max_box_per_image'],
+                                            anchors=config['model']['anchors'])
+    else:
+        import model_cache
+        model = model_cache.load_model(args.config, args.weights)
+
+    aps, report = evaluate(model, annotations, args.batch_size, args.iou_threshold)
+
+    for label in range(len(labels)):
+        print("{:<10} AP {:.4f}".format(labels[label], aps[label]))
+    print("mAP        {:.4f}".format(np.mean(list(aps.values()))))
+    print("images/sec {:.2f}".format(report['fps']))
+    print("latency    p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s  mean {:.3f}s".format(
+        report['latency_p50'], report['latency_p95'], report['latency_p99'], report['latency_mean']))
@@ -0,0 +1,502 @@
+'''
+Durable, offline-first recycling event log.
+Every recycling event (time, user, category, amount, confidence) is appended to a local
+SQLite database in WAL mode by a background writer thread, so recording an event never
+blocks on the disk or the network. A SyncWorker replicates the log to Firebase in batches:
+each batch is one atomic multi-path update carrying the events, the counter increments and
+the sync checkpoint (the id of the last event in it), so after a crash, power loss or
+network outage replication resumes from the checkpoint on the server, exactly once.
+Failed batches are retried with exponential backoff, and so are failed local writes (a full
+disk, a locked database): only an event with bad data is ever dropped.
+
+A reset (iot.firebase_reset) is itself an event, so counts can always be derived from
+the log: the counts are the events since the last reset.
+
+Aggregates are maintained incrementally, in the same transaction as the events they count,
+so stats never scan the events:
+  1. totals:  count per user and category since the last reset
+  2. rollups: count per user and category in hourly, daily and weekly buckets (UTC, weeks
+     start on Monday); a reset does not clear them, they are the history
+The SyncWorker replicates them as _totals/<kiosk>/<user>/<category> and
+_rollups/<kiosk>/<period>/<bucket>/<user>/<category>.
+
+Running this script benchmarks ingest and sync against firebase_local's stand-in server,
+including an outage and a restart; with --stats it times the stats queries as the log grows.
+'''
+
+import os
+import random
+import sqlite3
+import time
+from collections import Counter
+from queue import Queue
+from threading import Thread, Event
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    user TEXT,
+    category TEXT,
+    amount INTEGER NOT NULL,
+    confidence REAL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    user TEXT NOT NULL,
+    category TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user, category)
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    category TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (period, bucket, user, category)
+);
+'''
+
+# schema version with the totals and rollups; older logs get them built once on open
+VERSION = 1
+
+# rollup period: (bucket length, offset of the first bucket from the epoch), in seconds
+ROLLUPS = {'hourly': (3600, 0),
+           'daily': (86400, 0),
+           'weekly': (7 * 86400, 4 * 86400)}  # 1970-01-05 was a Monday
+
+# category of the event that resets every count to 0
+RESET = '__reset__'
+
+# errors of an event's data: writing it again would fail again
+DATA_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, ValueError, TypeError, OverflowError)
+
+
+def bucket(timestamp, period):
+    """Start time of the rollup bucket of the period containing timestamp"""
+    length, offset = ROLLUPS[period]
+    return int((timestamp - offset) // length * length + offset)
+
+
+class EventLog:
+    """
+    Append-only event store. append() only queues the event; the writer thread commits
+    everything queued in one transaction. Reads use their own connection, which WAL mode
+    lets run alongside the writer.
+    """
+
+    def __init__(self, path="data/events.db", initial_backoff=0.1, max_backoff=10.):
+        self.path = path
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        if connection.execute("PRAGMA user_version").fetchone()[0] < VERSION:
+            with connection:
+                self._rebuild(connection)
+            connection.execute("PRAGMA user_version={}".format(VERSION))
+        connection.close()
+
+        self.queue = Queue()
+        self.appended = 0
+        self.failures = 0
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # every commit is on disk before it returns: with NORMAL a power loss could lose events
+        # that were already replicated, and their ids would be reused (commits are batched,
+        # so the extra fsync is cheap)
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    def append(self, user, category, amount=1, confidence=None, timestamp=None):
+        self.queue.put((time.time() if timestamp is None else timestamp, user, category, amount, confidence))
+        self.appended += 1
+
+    def reset(self, timestamp=None):
+        self.append(None, RESET, 0, None, timestamp)
+
+    def update(self):
+        connection = self._connect()
+        while True:
+            rows = [self.queue.get()]
+            while not self.queue.empty():
+                rows.append(self.queue.get())
+
+            stop = None in rows
+            rows = [row for row in rows if row is not None]
+            done = len(rows) + stop
+            backoff = 0.
+            while rows:
+                try:
+                    self._commit(connection, rows)
+                except Exception as error:
+                    # a full disk, a locked database, an I/O error: keep the events and try again
+                    self.failures += 1
+                    backoff = min(self.max_backoff, max(self.initial_backoff, backoff * 2))
+                    print("[!] Event log write failed, retrying in {:.1f}s: {}".format(backoff, error))
+                    time.sleep(backoff)
+            for _ in range(done):
+                self.queue.task_done()
+            if stop:
+                connection.close()
+                return
+
+    def _commit(self, connection, rows):
+        """
+        Write rows, one by one if the batch has bad data so that only the bad events are dropped.
+        Any other error is raised, with the events not written yet left in rows.
+        """
+        try:
+            self._write(connection, rows)
+            del rows[:]
+        except DATA_ERRORS as error:
+            print("[!] Event log write failed, retrying event by event:", error)
+            while rows:
+                try:
+                    self._write(connection, rows[:1])
+                except DATA_ERRORS as error:
+                    print("[!] Event dropped:", rows[0], error)
+                del rows[0]
+
+    def _write(self, connection, rows):
+        try:
+            with connection:
+                connection.executemany(
+                    "INSERT INTO events (time, user, category, amount, confidence) VALUES (?, ?, ?, ?, ?)", rows)
+                self._aggregate(connection, rows)
+        except Exception:
+            # a failed commit leaves the transaction open: the retry must not add to it
+            connection.rollback()
+            raise
+
+    def _aggregate(self, connection, rows):
+        """Add rows to the totals and rollups"""
+        totals = Counter()
+        rollups = Counter()
+        for timestamp, user, category, amount, _ in rows:
+            if category == RESET:
+                connection.execute("DELETE FROM totals")
+                totals.clear()
+                continue
+            totals[user, category] += amount
+            for period in ROLLUPS:
+                rollups[period, bucket(timestamp, period), user, category] += amount
+
+        # INSERT OR IGNORE then UPDATE, not an upsert: ON CONFLICT needs SQLite 3.24, and
+        # Raspbian Stretch's Python links 3.16
+        connection.executemany("INSERT OR IGNORE INTO totals VALUES (?, ?, 0)", list(totals))
+        connection.executemany("UPDATE totals SET count = count + ? WHERE user = ? AND category = ?",
+                               [(count,) + key for key, count in totals.items()])
+        connection.executemany("INSERT OR IGNORE INTO rollups VALUES (?, ?, ?, ?, 0)", list(rollups))
+        connection.executemany(
+            "UPDATE rollups SET count = count + ? WHERE period = ? AND bucket = ? AND user = ? AND category = ?",
+            [(count,) + key for key, count in rollups.items()])
+
+    def _rebuild(self, connection):
+        """Recompute the totals and rollups from the events"""
+        connection.execute("DELETE FROM totals")
+        connection.execute("DELETE FROM rollups")
+        connection.execute(
+            "INSERT INTO totals SELECT user, category, SUM(amount) FROM events "
+            "WHERE id > (SELECT COALESCE(MAX(id), 0) FROM events WHERE category = ?) "
+            "GROUP BY user, category", (RESET,))
+        for period, (length, offset) in ROLLUPS.items():
+            connection.execute(
+                "INSERT INTO rollups SELECT ?, CAST((time - ?) / ? AS INTEGER) * ? + ?, user, category, SUM(amount) "
+                "FROM events WHERE category != ? GROUP BY 2, 3, 4",
+                (period, offset, length, length, offset, RESET))
+
+    def flush(self):
+        """Block until everything appended so far is committed"""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def read(self, after_id, limit):
+        """Events with an id above after_id, oldest first, as (id, time, user, category, amount, confidence)"""
+        return self._query(
+            "SELECT id, time, user, category, amount, confidence FROM events WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit))
+
+    def _query(self, sql, parameters=()):
+        connection = self._connect()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def counts(self):
+        """{user: {category: count}} of the events since the last reset"""
+        counts = {}
+        for user, category, count in self._query("SELECT user, category, count FROM totals"):
+            counts.setdefault(user, {})[category] = count
+        return counts
+
+    def stats(self):
+        """({user: count}, {category: count}) since the last reset"""
+        return (dict(self._query("SELECT user, SUM(count) FROM totals GROUP BY user")),
+                dict(self._query("SELECT category, SUM(count) FROM totals GROUP BY category")))
+
+    def leaderboard(self, k=5, period=None, since=None):
+        """
+        The k users with the most items as [(user, count)], best first: since the last reset,
+        or with a period, in the buckets from the one containing since (default: now) on
+        """
+        if period is None:
+            return self._query("SELECT user, SUM(count) AS total FROM totals "
+                               "GROUP BY user ORDER BY total DESC, user LIMIT ?", (k,))
+        start = bucket(time.time() if since is None else since, period)
+        return self._query("SELECT user, SUM(count) AS total FROM rollups WHERE period = ? AND bucket >= ? "
+                           "GROUP BY user ORDER BY total DESC, user LIMIT ?", (period, start, k))
+
+    def rollup(self, period, since=0, until=None):
+        """{bucket: {category: count}} of the period's buckets from since to until"""
+        rows = self._query("SELECT bucket, category, SUM(count) FROM rollups "
+                           "WHERE period = ? AND bucket >= ? AND bucket <= ? GROUP BY bucket, category",
+                           (period, bucket(since, period), bucket(time.time() if until is None else until, period)))
+        rollup = {}
+        for start, category, count in rows:
+            rollup.setdefault(start, {})[category] = count
+        return rollup
+
+    def keys(self, before_id=None):
+        """Distinct (user, category) pairs of the events (before before_id), excluding resets"""
+        return self._query("SELECT DISTINCT user, category FROM events WHERE category != ? AND id < ?",
+                           (RESET, before_id if before_id is not None else 2 ** 62))
+
+    def last_id(self):
+        return self._query("SELECT COALESCE(MAX(id), 0) FROM events")[0][0]
+
+    def skip_ids(self, last_id):
+        """Make sure new events get ids above last_id"""
+        connection = self._connect()
+        try:
+            with connection:
+                if connection.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'events'",
+                                      (last_id,)).rowcount == 0:
+                    connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('events', ?)", (last_id,))
+        finally:
+            connection.close()
+
+
+class SyncWorker:
+    """
+    Replicates an EventLog to Firebase (a db.Reference, or firebase_local.RestReference)
+    from a background thread. Events go to _events/<kiosk>/<id>, counts to <user>/<category>
+    and to the kiosk's totals and rollups, with the checkpoint at _sync/<kiosk>, all in one
+    multi-path update per batch.
+    """
+
+    def __init__(self, log, firebase, kiosk="kiosk", batch_size=500, interval=2.,
+                 initial_backoff=1., max_backoff=60.):
+        self.log = log
+        self.firebase = firebase
+        self.kiosk = kiosk
+        self.batch_size = batch_size
+        self.interval = interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.checkpoint = None
+        self.synced = 0
+        self.batches = 0
+        self.failures = 0
+        self.backoff = 0.
+        self.stopping = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def update(self):
+        while not self.stopping.is_set():
+            try:
+                if self.checkpoint is None:
+                    # resume from what the server has applied, not what we think we sent
+                    self.checkpoint = self.remote_checkpoint()
+                    if self.checkpoint > self.log.last_id():
+                        # the server has events this log lost (e.g. restored from a backup):
+                        # new events must not reuse their ids, or they would never be sent
+                        print("[!] Event log is behind the server's checkpoint {}, skipping ahead".format(
+                            self.checkpoint))
+                        self.log.skip_ids(self.checkpoint)
+                while not self.stopping.is_set() and self.sync_batch():
+                    pass
+                self.backoff = 0.
+                self.stopping.wait(self.interval)
+            except Exception as error:
+                self.failures += 1
+                self.backoff = min(self.max_backoff, max(self.initial_backoff, self.backoff * 2))
+                print("[!] Event sync failed, retrying in {:.1f}s: {}".format(self.backoff, error))
+                self.stopping.wait(self.backoff * random.uniform(0.8, 1.2))
+
+    def remote_checkpoint(self):
+        """Id of the last event the server has applied"""
+        return self.firebase.child('_sync').child(self.kiosk).get() or 0
+
+    def sync_batch(self):
+        """Replicate the next batch of events; returns whether there was one"""
+        events = self.log.read(self.checkpoint, self.batch_size)
+        if not events:
+            return False
+
+        # a reset ends a batch; the counts it zeroes cannot also be incremented in one update
+        for i, event in enumerate(events):
+            if event[3] == RESET:
+                events = events[:i] if i > 0 else events[:1]
+                break
+
+        update = {}
+        if events[0][3] == RESET:
+            # zero every count this kiosk has ever written, without reading the tree back
+            totals = {}
+            for user, category in self.log.keys(before_id=events[0][0]):
+                update[user + '/' + category] = 0
+                totals.setdefault(user, {})[category] = 0
+            update['_totals/' + self.kiosk] = totals
+        else:
+            totals = Counter()
+            for _, timestamp, user, category, amount, _ in events:
+                key = user + '/' + category
+                totals[key] += amount
+                totals['_totals/' + self.kiosk + '/' + key] += amount
+                for period in ROLLUPS:
+                    totals['/'.join(('_rollups', self.kiosk, period, str(bucket(timestamp, period)), key))] += amount
+            update.update((key, {'.sv': {'increment': amount}}) for key, amount in totals.items())
+
+        prefix = '_events/' + self.kiosk + '/'
+        for event_id, timestamp, user, category, amount, confidence in events:
+            update[prefix + str(event_id)] = {'time': timestamp, 'user': user, 'category': category,
+                                              'amount': amount, 'confidence': confidence}
+        update['_sync/' + self.kiosk] = events[-1][0]
+
+        self.firebase.update(update)
+        self.checkpoint = events[-1][0]
+        self.synced += len(events)
+        self.batches += 1
+        return True
+
+    def pending(self):
+        return self.log.last_id() - (self.checkpoint or 0)
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+    from firebase_local import LocalDatabaseServer, RestReference
+
+    parser = argparse.ArgumentParser(description='Benchmark event log ingest and sync')
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated round-trip, seconds')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--stats', action='store_true', help='time the stats queries as the log grows instead')
+    parser.add_argument('--sizes', default='10000,100000,1000000,3000000', help='log sizes for --stats')
+    args = parser.parse_args()
+
+    users = ['ken', 'tim', 'grace', 'shelly', 'frank']
+    categories = ['bottles', 'cans']
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'events.db')
+
+    def timed(function, repeat=100):
+        start = time.time()
+        for _ in range(repeat):
+            function()
+        return (time.time() - start) / repeat * 1000
+
+    if args.stats:
+        # stats from the aggregates against the same stats computed from the events
+        log = EventLog(path)
+        random.seed(0)
+        now = time.time()
+        size = 0
+        print("{:>9} {:>10} {:>12} {:>12} {:>12}".format(
+            'events', 'stats ms', 'top-5 ms', 'week top-5', 'scan ms'))
+        for target in [int(n) for n in args.sizes.split(',')]:
+            # events spread over the last 90 days
+            while size < target:
+                log.append(random.choice(users), random.choice(categories),
+                           timestamp=now - random.random() * 90 * 86400)
+                size += 1
+            log.flush()
+            scan = "SELECT user, SUM(amount) FROM events WHERE category != '{}' GROUP BY user".format(RESET)
+            print("{:>9} {:>10.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                size, timed(log.stats), timed(log.leaderboard),
+                timed(lambda: log.leaderboard(period='weekly', since=now)), timed(lambda: log._query(scan), 3)))
+        log.close()
+        shutil.rmtree(directory)
+        raise SystemExit
+
+    # ingest: how fast events can be recorded and committed
+    log = EventLog(path)
+    start = time.time()
+    for i in range(args.events):
+        log.append(users[i % 5], categories[i % 2], confidence=0.9)
+    queued = time.time() - start
+    log.flush()
+    committed = time.time() - start
+    print("ingest   {:.0f} events/s queued, {:.0f} events/s committed".format(
+        args.events / queued, args.events / committed))
+
+    # sync: replicate everything, with the network down for the first second
+    server = LocalDatabaseServer(latency=args.latency)
+    port = server.server.server_address[1]
+    server.server.server_close()
+    sync = SyncWorker(log, RestReference('http://127.0.0.1:{}'.format(port)), batch_size=args.batch_size,
+                      interval=0.2, initial_backoff=0.5).start()
+    time.sleep(1.)
+    server = LocalDatabaseServer(latency=args.latency, port=port).start()
+    start = time.time()
+    while sync.pending() > 0:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    print("sync     {:.0f} events/s in {} batches ({} failed attempts during the outage)".format(
+        args.events / elapsed, sync.batches, sync.failures))
+    sync.stop()
+
+    # restart: more events, a fresh log and worker on the same file resume from the checkpoint
+    for i in range(1000):
+        log.append(users[i % 5], categories[i % 2])
+    log.close()
+    log = EventLog(path)
+    sync = SyncWorker(log, RestReference(server.url), batch_size=args.batch_size, interval=0.2).start()
+    while sync.pending() > 0:
+        time.sleep(0.01)
+    sync.stop()
+
+    remote = RestReference(server.url).get()
+    assert all(remote[user][category] == count == remote['_totals']['kiosk'][user][category]
+               for user, counts in log.counts().items() for category, count in counts.items())
+    print("restart  resumed at event {}, remote counts match the local log".format(args.events))
+
+    # remote stats: the bins' totals against the whole tree the old firebase_stats read
+    import iot
+    server.latency = 0.
+    firebase = RestReference(server.url)
+    assert iot.firebase_stats(firebase)[0] == {user: sum(counts.values()) for user, counts in log.counts().items()}
+    print("stats    {:.1f} ms from _totals, {:.1f} ms reading the whole tree".format(
+        timed(lambda: iot.firebase_stats(firebase), 10), timed(firebase.get, 10)))
+    print("requests", dict(server.requests))
+
+    log.close()
+    server.stop()
+    shutil.rmtree(directory)
@@ -0,0 +1,79 @@
+'''
+Debounced detection events.
+DetectionEvents votes over the last few detection results: a label counts as present
+once it was detected in at least appear_votes of the last `window` results, and as gone
+once it was detected in at most leave_votes of them. Only changes are reported, as events:
+  appeared:        a recyclable came into view
+  left:            a recyclable is no longer in view (e.g. it was thrown in the bin)
+  user_identified: a user label came into view
+so single-frame misses or false positives cause no flicker, and each disposal is seen once.
+Subscribers are called with every event; UI, LEDs and IoT react to them instead of
+re-deriving the state on every tick.
+'''
+
+from collections import deque, namedtuple
+
+import numpy as np
+
+# confidence: mean score of the label over the detection results it was seen in
+Event = namedtuple('Event', ['kind', 'label', 'timestamp', 'duration', 'confidence'])
+
+
+class DetectionEvents:
+    """
+    labels:       the model's labels
+    recyclables:  labels that are items; every other label is a user
+    window:       number of detection results voted over
+    appear_votes: detections within the window for a label to appear
+    leave_votes:  a present label leaves once detected in at most this many
+    """
+
+    def __init__(self, labels, recyclables=("can", "bottle"), window=5, appear_votes=3, leave_votes=1):
+        self.labels = labels
+        self.recyclables = set(recyclables)
+        self.window = window
+        self.appear_votes = appear_votes
+        self.leave_votes = leave_votes
+        self.history = deque(maxlen=window)
+        self.present = {}  # label -> timestamp it appeared
+        self.confidence = {}  # label -> confidence when it appeared
+        self.current_user = None
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """Call callback(event) for every future event"""
+        self.subscribers.append(callback)
+        return callback
+
+    def update(self, detections, timestamp):
+        """Vote with one detection result; returns the events it caused, after dispatching them"""
+        # highest score of each label in this result, 0 if not detected
+        scores = np.zeros(len(self.labels), dtype=np.float32)
+        np.maximum.at(scores, detections.labels, detections.scores)
+        self.history.append(scores)
+        history = np.array(self.history)
+        votes = np.count_nonzero(history, axis=0)
+        confidence = history.sum(axis=0) / np.maximum(votes, 1)
+
+        events = []
+        for label_id, label in enumerate(self.labels):
+            if label not in self.present and votes[label_id] >= self.appear_votes:
+                self.present[label] = timestamp
+                self.confidence[label] = float(confidence[label_id])
+                if label in self.recyclables:
+                    events.append(Event('appeared', label, timestamp, 0., float(confidence[label_id])))
+                elif label != self.current_user:
+                    self.current_user = label
+                    events.append(Event('user_identified', label, timestamp, 0., float(confidence[label_id])))
+            elif label in self.present and votes[label_id] <= self.leave_votes:
+                appeared = self.present.pop(label)
+                if label in self.recyclables:
+                    events.append(Event('left', label, timestamp, timestamp - appeared, self.confidence.pop(label)))
+
+        for event in events:
+            for callback in self.subscribers:
+                callback(event)
+        return events
+
+    def present_recyclables(self):
+        return set(self.present) & self.recyclables
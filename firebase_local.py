@@ -0,0 +1,223 @@
+'''
+A local, in-process stand-in for the Firebase Realtime Database REST API,
+to exercise and time the iot.py functions without a network or credentials.
+  1. LocalDatabaseServer: serves an in-memory JSON tree over HTTP, supporting GET, PUT,
+     PATCH (multi-path updates) and DELETE on /<path>.json, and the
+     {".sv": {"increment": n}} server value; it counts the requests it receives
+  2. RestReference: a minimal client with the subset of firebase_admin.db.Reference
+     used by iot.py (child, get, set, update), talking to any REST endpoint
+An optional per-request delay stands in for the round-trip to the real database.
+
+Running this script compares per-increment firebase_update calls with the CounterAggregator.
+'''
+
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import Request, urlopen
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _split(path):
+    return [part for part in path.strip('/').split('/') if part]
+
+
+def _resolve(value, current):
+    """Apply server values ({".sv": {"increment": n}}) against the current value"""
+    if isinstance(value, dict):
+        if '.sv' in value:
+            return (current if isinstance(current, (int, float)) else 0) + value['.sv']['increment']
+        current = current if isinstance(current, dict) else {}
+        return {key: _resolve(child, current.get(key)) for key, child in value.items()}
+    return value
+
+
+class LocalDatabaseServer:
+    """In-memory Realtime Database served on 127.0.0.1; every write is applied atomically"""
+
+    def __init__(self, data=None, latency=0., port=0):
+        self.data = data or {}
+        self.latency = latency
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.server = _ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def get(self, parts):
+        node = self.data
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def put(self, parts, value):
+        if not parts:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node = self.data
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+    def _handler(self):
+        database = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, value):
+                body = json.dumps(value).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _parts(self):
+                path = self.path.split('?')[0]
+                if path.endswith('.json'):
+                    path = path[:-len('.json')]
+                return _split(path)
+
+            def _body(self):
+                return json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+
+            def _handle(self, method):
+                time.sleep(database.latency)
+                parts = self._parts()
+                with database.lock:
+                    database.requests[method] += 1
+                    if method == 'GET':
+                        result = database.get(parts)
+                    elif method == 'PUT':
+                        result = _resolve(self._body(), database.get(parts))
+                        database.put(parts, result)
+                    elif method == 'PATCH':
+                        result = {}
+                        for key, value in self._body().items():
+                            child = parts + _split(key)
+                            result[key] = _resolve(value, database.get(child))
+                            database.put(child, result[key])
+                    else:
+                        database.put(parts, None)
+                        result = None
+                self._respond(result)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_PATCH(self):
+                self._handle('PATCH')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RestReference:
+    """The child/get/set/update subset of firebase_admin.db.Reference, over the REST API"""
+
+    def __init__(self, url, path='/'):
+        self.url = url.rstrip('/')
+        self.path = '/' + '/'.join(_split(path))
+
+    def child(self, path):
+        return RestReference(self.url, self.path.rstrip('/') + '/' + path)
+
+    def _request(self, method, value=None):
+        data = None if value is None else json.dumps(value).encode()
+        path = '/.json' if self.path == '/' else self.path + '.json'
+        request = Request(self.url + path, data=data, method=method)
+        request.add_header('Content-Type', 'application/json')
+        with urlopen(request) as response:
+            return json.loads(response.read().decode())
+
+    def get(self):
+        return self._request('GET')
+
+    def set(self, value):
+        self._request('PUT', value)
+
+    def update(self, value):
+        self._request('PATCH', value)
+
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import iot
+
+    parser = argparse.ArgumentParser(description='Compare Firebase counter updates on a local stand-in database')
+    parser.add_argument('--increments', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated round-trip, seconds')
+    parser.add_argument('--interval', type=float, default=1.)
+    args = parser.parse_args()
+
+    random.seed(0)
+    increments = [(random.choice(iot.USERS), random.choice(iot.CATEGORIES)) for _ in range(args.increments)]
+
+    def old_firebase_update(firebase, user, category, increment):
+        # the original read-modify-write, returning the whole tree
+        current = firebase.child(user).child(category).get()
+        firebase.child(user).child(category).set(current + increment)
+        return firebase.get()
+
+    for name in ('get/set per increment', 'CounterAggregator'):
+        server = LocalDatabaseServer(latency=args.latency).start()
+        firebase = RestReference(server.url)
+        iot.firebase_reset(firebase)
+        server.requests.clear()
+
+        start = time.time()
+        if name == 'CounterAggregator':
+            aggregator = iot.CounterAggregator(firebase, args.interval).start()
+            for user, category in increments:
+                aggregator.add(user, category)
+                time.sleep(0.005)
+            aggregator.stop()
+            report = aggregator.report()
+        else:
+            for user, category in increments:
+                old_firebase_update(firebase, user, category, 1)
+        elapsed = time.time() - start
+
+        totals = Counter()
+        for user, category in increments:
+            totals[user, category] += 1
+        data = firebase.get()
+        assert all(data[user][category] == totals[user, category] for user in iot.USERS for category in iot.CATEGORIES)
+
+        print("{:<22} {} requests ({}) in {:.1f}s".format(
+            name, sum(server.requests.values()), dict(server.requests), elapsed))
+        if name == 'CounterAggregator':
+            print("{:<22} {} flushes, {} writes saved, flush latency p50 {:.0f}ms max {:.0f}ms".format(
+                '', report['flushes'], report['writes_saved'],
+                report['flush_latency_p50'] * 1000, report['flush_latency_max'] * 1000))
+        server.stop()
@@ -0,0 +1,384 @@
+'''
+Fleet telemetry: many SmartBins reporting their recycling events to one collector.
+  1. Collector: an HTTP service (runnable locally) that ingests batches of events from
+     any number of bins, gzip-compressed JSON posted to /bins/<bin id>/events over
+     keep-alive connections. Events are deduplicated by (bin id, event id), so a batch
+     sent twice (e.g. after a lost response) counts once, and fleet-wide totals per bin,
+     user and category are updated in the same SQLite transaction as the events
+  2. BinClient: a bin's side of the protocol, holding one persistent connection
+  3. FleetUploader: a SyncWorker that uploads a bin's EventLog to the collector instead of
+     Firebase, resuming from the collector's checkpoint for the bin
+Endpoints: POST /bins/<bin>/events, GET /bins/<bin>/checkpoint, GET /stats, GET /metrics.
+
+  python3 fleet.py serve --port 8002 --db data/fleet.db
+  python3 fleet.py load --bins 200 --events 500     # load generator against a local collector
+'''
+
+import gzip
+import json
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+
+from event_log import RESET, SyncWorker
+from metrics import METRICS
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    bin TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    user TEXT,
+    category TEXT,
+    amount INTEGER NOT NULL,
+    confidence REAL,
+    PRIMARY KEY (bin, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS totals (
+    bin TEXT NOT NULL,
+    user TEXT NOT NULL,
+    category TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (bin, user, category)
+);
+'''
+
+
+def parse_events(body, encoding=None):
+    """A batch of [id, time, user, category, amount, confidence] events from a request body; ValueError if invalid"""
+    try:
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        events = json.loads(body.decode())
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as error:
+        raise ValueError("unreadable body: {}".format(error))
+    if not isinstance(events, list):
+        raise ValueError("expected a list of events")
+    for event in events:
+        if (not isinstance(event, list) or len(event) != 6 or not isinstance(event[0], int)
+                or not isinstance(event[1], (int, float)) or not isinstance(event[3], str)
+                or not (isinstance(event[2], str) or event[3] == RESET) or not isinstance(event[4], int)):
+            raise ValueError("invalid event: {!r}".format(event))
+    return events
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class Collector:
+    """
+    Fleet event store behind an HTTP server. Each bin's connection gets its own thread;
+    writes go through one SQLite connection, one transaction per batch.
+    """
+
+    def __init__(self, path="data/fleet.db", port=8002, host='127.0.0.1'):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = Lock()
+        self.accepted = 0
+        self.duplicates = 0
+        self.server = _ThreadingHTTPServer((host, port), self._handler())
+        self.url = 'http://{}:{}'.format(host, self.server.server_address[1])
+
+    def ingest(self, bin_id, events):
+        """
+        Store a batch of [id, time, user, category, amount, confidence] events of a bin;
+        returns (events new to the collector, the bin's checkpoint)
+        """
+        if not events:
+            return 0, self.checkpoint(bin_id)
+        ids = [event[0] for event in events]
+        with self.lock, self.connection:
+            # one range lookup on the primary key finds the events already stored
+            seen = set(row[0] for row in self.connection.execute(
+                "SELECT id FROM events WHERE bin = ? AND id BETWEEN ? AND ?", (bin_id, min(ids), max(ids))))
+            new = []
+            for event in sorted(events, key=lambda event: event[0]):
+                if event[0] not in seen:
+                    seen.add(event[0])
+                    new.append(event)
+            self.connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [[bin_id] + list(event) for event in new])
+
+            totals = Counter()
+            for _, _, user, category, amount, _ in new:
+                if category == RESET:
+                    # counts of this bin start again from 0
+                    self.connection.execute("DELETE FROM totals WHERE bin = ?", (bin_id,))
+                    totals.clear()
+                    continue
+                totals[user, category] += amount
+            # INSERT OR IGNORE then UPDATE: upserts need SQLite 3.24
+            self.connection.executemany("INSERT OR IGNORE INTO totals VALUES (?, ?, ?, 0)",
+                                        [(bin_id, user, category) for user, category in totals])
+            self.connection.executemany(
+                "UPDATE totals SET count = count + ? WHERE bin = ? AND user = ? AND category = ?",
+                [(count, bin_id, user, category) for (user, category), count in totals.items()])
+
+            self.accepted += len(new)
+            self.duplicates += len(events) - len(new)
+            return len(new), self._checkpoint(bin_id)
+
+    def _checkpoint(self, bin_id):
+        return self.connection.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM events WHERE bin = ?", (bin_id,)).fetchone()[0]
+
+    def checkpoint(self, bin_id):
+        """Id of the last event of the bin the collector has"""
+        with self.lock:
+            return self._checkpoint(bin_id)
+
+    def stats(self):
+        """Fleet-wide {'by_user', 'by_category', 'by_bin'} counts since each bin's last reset"""
+        with self.lock:
+            return {'by_' + dimension: dict(self.connection.execute(
+                        "SELECT {0}, SUM(count) FROM totals GROUP BY {0}".format(dimension)).fetchall())
+                    for dimension in ('user', 'category', 'bin')}
+
+    def _handler(self):
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive: a bin sends all its batches over one connection
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes: without TCP_NODELAY the body waits
+            # for the client's delayed ACK, adding ~40ms to every request
+            disable_nagle_algorithm = True
+
+            def _respond(self, value, status=200, content_type='application/json'):
+                body = value.encode() if isinstance(value, str) else json.dumps(value).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                parts = self.path.strip('/').split('/')
+                try:
+                    length = int(self.headers['Content-Length'])
+                except (TypeError, ValueError):
+                    # the body cannot be skipped without its length: the connection is unusable
+                    self.close_connection = True
+                    return self._respond({'error': 'Content-Length required'}, 411)
+                body = self.rfile.read(length)
+                if len(parts) != 3 or parts[0] != 'bins' or parts[2] != 'events':
+                    return self._respond({'error': 'not found'}, 404)
+                start = time.time()
+                try:
+                    events = parse_events(body, self.headers.get('Content-Encoding'))
+                except ValueError as error:
+                    return self._respond({'error': str(error)}, 400)
+                accepted, checkpoint = collector.ingest(parts[1], events)
+                METRICS.record('fleet_ingest', time.time() - start)
+                self._respond({'accepted': accepted, 'duplicates': len(events) - accepted,
+                               'checkpoint': checkpoint})
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if parts == ['stats']:
+                    self._respond(collector.stats())
+                elif parts == ['metrics']:
+                    self._respond(METRICS.text(), content_type='text/plain; version=0.0.4')
+                elif len(parts) == 3 and parts[0] == 'bins' and parts[2] == 'checkpoint':
+                    self._respond({'checkpoint': collector.checkpoint(parts[1])})
+                else:
+                    self._respond({'error': 'not found'}, 404)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.connection.close()
+
+
+class BinClient:
+    """One bin's connection to the collector, reopened if it drops"""
+
+    def __init__(self, url, bin_id, timeout=10.):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.bin_id = bin_id
+        self.timeout = timeout
+        self.connection = None
+
+    def _request(self, method, path, body=None, headers=None):
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body, headers or {})
+                response = self.connection.getresponse()
+                reply = json.loads(response.read().decode())
+            except (ConnectionError, OSError):
+                # the server may have closed an idle keep-alive connection: retry once on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt == 2:
+                    raise
+                continue
+            if response.status != 200:
+                raise RuntimeError("Collector replied {}: {}".format(response.status, reply.get('error')))
+            return reply
+
+    def upload(self, events):
+        """Send [id, time, user, category, amount, confidence] events; returns the collector's reply"""
+        body = gzip.compress(json.dumps([list(event) for event in events]).encode())
+        return self._request('POST', '/bins/{}/events'.format(self.bin_id), body,
+                             {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+    def checkpoint(self):
+        return self._request('GET', '/bins/{}/checkpoint'.format(self.bin_id))['checkpoint']
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class FleetUploader(SyncWorker):
+    """Uploads an EventLog to a collector through a BinClient, in batches, with SyncWorker's retries"""
+
+    def __init__(self, log, client, **kwargs):
+        super(FleetUploader, self).__init__(log, None, kiosk=client.bin_id, **kwargs)
+        self.client = client
+
+    def remote_checkpoint(self):
+        return self.client.checkpoint()
+
+    def sync_batch(self):
+        events = self.log.read(self.checkpoint, self.batch_size)
+        if not events:
+            return False
+        self.checkpoint = self.client.upload(events)['checkpoint']
+        self.synced += len(events)
+        self.batches += 1
+        return True
+
+
+def simulate_bins(url, bin_ids, events, batch_size, resend, interval, results, seed):
+    """
+    Load generator process: one thread per bin, each uploading `events` random events in
+    batches, one every `interval` seconds (0: as fast as the collector answers), and resending
+    a batch with probability `resend`; puts per-request latencies and the events sent on results
+    """
+    import random
+
+    def run(bin_id, latencies, sent):
+        rng = random.Random(seed + bin_id)
+        client = BinClient(url, 'bin{:04d}'.format(bin_id))
+        # bins upload out of phase with each other
+        next_upload = time.time() + rng.random() * interval
+        users = ['ken', 'tim', 'grace', 'shelly', 'frank']
+        categories = ['bottles', 'cans', 'others']
+        for first in range(1, events + 1, batch_size):
+            time.sleep(max(next_upload - time.time(), 0))
+            next_upload += interval
+            batch = [[i, time.time(), rng.choice(users), rng.choice(categories), 1, rng.random()]
+                     for i in range(first, min(first + batch_size, events + 1))]
+            for _ in range(2 if rng.random() < resend else 1):
+                start = time.time()
+                client.upload(batch)
+                latencies.append(time.time() - start)
+            sent.update((user, category) for _, _, user, category, _, _ in batch)
+        client.close()
+
+    # one list and Counter per bin: Counter.update is not atomic across threads
+    latencies = [[] for _ in bin_ids]
+    sent = [Counter() for _ in bin_ids]
+    threads = [Thread(target=run, args=(bin_id, latencies[i], sent[i])) for i, bin_id in enumerate(bin_ids)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(([latency for bin_latencies in latencies for latency in bin_latencies], sum(sent, Counter())))
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import shutil
+    import tempfile
+    from multiprocessing import Process, Queue
+
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description='Run the fleet collector, or load-test one')
+    parser.add_argument('mode', choices=['serve', 'load'])
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--db', default='data/fleet.db')
+    parser.add_argument('--bins', type=int, default=200)
+    parser.add_argument('--events', type=int, default=500, help='events per bin')
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--resend', type=float, default=0.05, help='fraction of batches sent twice')
+    parser.add_argument('--interval', type=float, default=0., help='seconds between uploads of a bin, 0: flat out')
+    parser.add_argument('--processes', type=int, default=4, help='load generator processes')
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        collector = Collector(args.db, args.port, host='0.0.0.0').start()
+        print("[i] Fleet collector listening on port", args.port)
+        try:
+            while True:
+                time.sleep(60)
+                print("[i] {} events accepted, {} duplicates".format(collector.accepted, collector.duplicates))
+        except KeyboardInterrupt:
+            collector.stop()
+        raise SystemExit
+
+    directory = tempfile.mkdtemp()
+    collector = Collector(os.path.join(directory, 'fleet.db'), port=0).start()
+
+    results = Queue()
+    processes = [Process(target=simulate_bins,
+                         args=(collector.url, list(range(p, args.bins, args.processes)), args.events,
+                               args.batch_size, args.resend, args.interval, results, 0))
+                 for p in range(args.processes)]
+    start = time.time()
+    for process in processes:
+        process.start()
+    latencies = []
+    sent = Counter()
+    for _ in processes:
+        process_latencies, process_sent = results.get()
+        latencies += process_latencies
+        sent.update(process_sent)
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start
+
+    stats = collector.stats()
+    by_user = Counter()
+    for (user, _), count in sent.items():
+        by_user[user] += count
+    assert stats['by_user'] == dict(by_user) and len(stats['by_bin']) == args.bins
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    print("{} bins, {} events in {} requests ({} duplicate events dropped)".format(
+        args.bins, collector.accepted, len(latencies), collector.duplicates))
+    print("ingest  {:.0f} events/s, {:.0f} requests/s".format(collector.accepted / elapsed, len(latencies) / elapsed))
+    print("latency p50 {:.1f} ms  p95 {:.1f} ms  p99 {:.1f} ms".format(p50, p95, p99))
+    print("fleet totals match the events sent")
+
+    collector.stop()
+    shutil.rmtree(directory)
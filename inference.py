@@ -0,0 +1,285 @@
+'''
+Inference scheduling for the SmartBin computer vision pipeline.
+  1. InferenceLoop waits for each new camera frame and runs the model on it,
+     unless the MotionGate reports that nothing has changed since the last inference
+  2. BatchScheduler gathers the newest frame from several camera streams and
+     runs them through the object detection model as one batch
+Running this script benchmarks throughput and latency for a range of batch sizes.
+'''
+
+import time
+from collections import deque
+from threading import Thread
+
+import cv2
+import numpy as np
+
+from box_utils import Detections
+
+
+class InferenceStats:
+    """
+    Rolling record of the most recent batches pushed through the model.
+    Reports throughput (frames/sec) and per-frame latency in seconds.
+    """
+
+    def __init__(self, window=100):
+        self.batches = deque(maxlen=window)
+        self.frames = 0
+
+    def record(self, nb_frames, start, end):
+        self.batches.append((nb_frames, start, end))
+        self.frames += nb_frames
+
+    def report(self):
+        if not self.batches:
+            return {'frames': self.frames, 'fps': 0.0,
+                    'latency_mean': 0.0, 'latency_p50': 0.0, 'latency_p95': 0.0, 'latency_p99': 0.0}
+
+        nb_frames = np.array([b[0] for b in self.batches])
+        starts = np.array([b[1] for b in self.batches])
+        ends = np.array([b[2] for b in self.batches])
+
+        # every frame in a batch waits for the whole batch to finish
+        latencies = np.repeat(ends - starts, nb_frames)
+        wall_time = max(ends[-1] - starts[0], 1e-9)
+
+        return {'frames': self.frames,
+                'fps': float(nb_frames.sum() / wall_time),
+                'latency_mean': float(latencies.mean()),
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'latency_p99': float(np.percentile(latencies, 99))}
+
+
+# per-thread CPU time where available (Python 3.7+), wall time otherwise
+_thread_time = getattr(time, 'thread_time', time.time)
+
+
+class MotionGate:
+    """
+    Cheap change detector for a static camera.
+    Each frame is shrunk to a small greyscale thumbnail and compared with the
+    thumbnail of the last frame that was run through the model; inference is only
+    needed when the mean absolute difference exceeds threshold (in 0-255 grey levels),
+    or when the last inference is older than max_age seconds.
+    """
+
+    def __init__(self, threshold=4.0, size=(32, 32), max_age=2.0):
+        self.threshold = threshold
+        self.size = size
+        self.max_age = max_age
+        self.reference = None
+        self.reference_time = None
+
+    def changed(self, frame, timestamp):
+        thumbnail = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        thumbnail = thumbnail.mean(axis=2, dtype=np.float32)
+
+        if (self.reference is None
+                or timestamp - self.reference_time > self.max_age
+                or np.abs(thumbnail - self.reference).mean() > self.threshold):
+            self.reference = thumbnail
+            self.reference_time = timestamp
+            return True
+
+        return False
+
+
+class InferenceLoop:
+    """
+    Streaming inferences independently of camera and UI updates.
+    Blocks until the stream has a frame newer than the last one seen, and
+    reuses the previous detections when the MotionGate sees no change, or when
+    the last inference is less than min_interval seconds old (the cadence the
+    UI's FramePacer asks for, see pacing.py). Only in the first case are they
+    published again with the new frame's timestamp.
+    """
+
+    def __init__(self, model, stream, motion_gate=True, log_interval=60, min_interval=0.):
+        self.model = model
+        self.stream = stream
+        self.gate = MotionGate() if motion_gate else None
+        self.min_interval = min_interval
+        self.last_inference = 0.
+        self.log_interval = log_interval
+        self.boxes = Detections.empty(model.nb_class)
+        # (frame timestamp, detections, number of the inference that produced them)
+        self.latest = (None, self.boxes, 0)
+        self.seq = -1
+        self.frames = 0
+        self.inferences = 0
+        self.inference_cpu = 0.
+        self.stopped = False
+
+    def start(self):
+        # start the thread to run inference on the video stream
+        Thread(target=self.update, args=()).start()
+        return self
+
+    def update(self):
+        last_log = time.time()
+        # keep looping infinitely until the thread is stopped
+        while not self.stopped:
+            self.step(timeout=1.0)
+            if self.log_interval and time.time() - last_log > self.log_interval:
+                last_log = time.time()
+                self.log()
+
+    def step(self, timeout=None):
+        """Process the next new frame; returns False if none arrived within timeout"""
+        latest = self.stream.read_latest(newer_than=self.seq, timeout=timeout)
+        if latest is None:
+            return False
+
+        self.seq, timestamp, frame = latest
+        self.frames += 1
+
+        if timestamp - self.last_inference < self.min_interval:
+            # too soon: the scene may have moved, so the last detections keep
+            # the timestamp of the frame they were inferred on
+            return True
+
+        if self.gate is None or self.gate.changed(frame, timestamp):
+            self.last_inference = timestamp
+            start = _thread_time()
+            self.boxes = self.model.predict(frame)
+            self.inference_cpu += _thread_time() - start
+            self.inferences += 1
+
+        # the detections describe this frame (reused ones: the gate saw no change)
+        self.latest = (timestamp, self.boxes, self.inferences)
+        return True
+
+    def read(self):
+        return self.boxes
+
+    def read_timed(self):
+        """Returns (timestamp of the frame the detections describe, detections)"""
+        return self.latest[:2]
+
+    def read_inference(self):
+        """
+        Returns (timestamp, detections, inference number); the number only changes
+        with a new inference, not when its detections are re-stamped for an unchanged frame
+        """
+        return self.latest
+
+    def report(self):
+        """Skip ratio, and the CPU time saved by skipping (at the mean cost of an inference)"""
+        skipped = self.frames - self.inferences
+        mean_cpu = self.inference_cpu / max(self.inferences, 1)
+        return {'frames': self.frames,
+                'inferences': self.inferences,
+                'skip_ratio': skipped / float(max(self.frames, 1)),
+                'cpu_used': self.inference_cpu,
+                'cpu_saved': skipped * mean_cpu}
+
+    def log(self):
+        report = self.report()
+        print("[i] Inference: {} of {} frames skipped ({:.0%}), ~{:.1f}s CPU saved".format(
+            report['frames'] - report['inferences'], report['frames'],
+            report['skip_ratio'], report['cpu_saved']))
+
+    def stop(self):
+        self.stopped = True
+
+
+class BatchScheduler:
+    """
+    Streaming inferences for several PiVideoStream-like sources at once.
+    Each cycle takes the newest frame from every source, runs them through
+    ObjectDetection.predict_batch, and hands back the detections per source.
+    """
+
+    def __init__(self, model, sources, batch_size=None):
+        self.model = model
+        self.sources = list(sources)
+        self.batch_size = batch_size or len(self.sources)
+        self.results = [Detections.empty(model.nb_class) for _ in self.sources]
+        self.stats = InferenceStats()
+        self.stopped = False
+
+    def start(self):
+        # start the thread to run inference on the video streams
+        Thread(target=self.update, args=()).start()
+        return self
+
+    def update(self):
+        # keep looping infinitely until the thread is stopped
+        while not self.stopped:
+            self.step()
+
+    def step(self):
+        """Run one inference cycle over all sources"""
+        frames = [source.read() for source in self.sources]
+        start = time.time()
+        results = self.model.predict_batch(frames, self.batch_size)
+        self.stats.record(len(frames), start, time.time())
+        self.results = results
+        return results
+
+    def read(self, source_id=0):
+        return self.results[source_id]
+
+    def stop(self):
+        self.stopped = True
+
+
+def benchmark_batch_sizes(model, frames, batch_sizes, repeats=5):
+    """
+    Push the same backlog of frames through the model once per batch size.
+    Returns a dictionary of batch size -> InferenceStats report.
+    """
+    reports = {}
+
+    for batch_size in batch_sizes:
+        stats = InferenceStats(window=repeats * len(frames))
+        model.predict_batch(frames[:batch_size], batch_size)  # warm up
+
+        for _ in range(repeats):
+            for i in range(0, len(frames), batch_size):
+                chunk = frames[i:i + batch_size]
+                start = time.time()
+                model.predict_batch(chunk, batch_size)
+                stats.record(len(chunk), start, time.time())
+
+        reports[batch_size] = stats.report()
+
+    return reports
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    from object_detection_model import ObjectDetection
+
+    parser = argparse.ArgumentParser(description='Benchmark batched inference')
+    parser.add_argument('--config', default='data/config.json')
+    parser.add_argument('--weights', default='data/best_weights_11.h5')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--frames', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.config) as config_buffer:
+        config = json.load(config_buffer)
+
+    model = ObjectDetection(backend=config['model']['backend'],
+                            input_size=config['model']['input_size'],
+                            labels=config['model']['labels'],
+                            max_box_per_image=config['model']['max_box_per_image'],
+                            anchors=config['model']['anchors'])
+    model.load_weights(args.weights)
+
+    size = config['model']['input_size']
+    frames = [np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+              for _ in range(args.frames)]
+
+    reports = benchmark_batch_sizes(model, frames, args.batch_sizes, args.repeats)
+
+    print("batch  fps     latency_mean  latency_p50  latency_p95")
+    for batch_size in args.batch_sizes:
+        r = reports[batch_size]
+        print("{:<6} {:<7.2f} {:<13.3f} {:<12.3f} {:.3f}".format(
+            batch_size, r['fps'], r['latency_mean'], r['latency_p50'], r['latency_p95']))
@@ -3,12 +3,35 @@ This script contains functions for integrating internet of things in the form of
 To summarise, the functions set up, update, reset, randomise values, consolidate and plot statistics.
 They do this by manipulating the data streams to and from the authenticated firebase instance.
 The functions will be imported from this script to perform iot tasks within the SmartBinApp.py main script.
+firebase_admin and matplotlib are only imported by the functions that need them,
+so importing this script costs nothing while Firebase is not in use.
+Counts are only ever changed with server-side increments in multi-path updates, so
+concurrent writers never overwrite each other and nothing needs to be read first;
+CounterAggregator batches increments further, flushing them in the background.
+Every function also accepts an event_log.EventLog in place of the firebase reference:
+events are then recorded locally (and replicated by a SyncWorker) and stats are read from the log.
+Next to the per-user counts, every write also keeps the totals of its bin (kiosk) at
+_totals/<kiosk>/<user>/<category>, so stats and leaderboards read those small nodes
+instead of the whole database, whose size grows with the replicated events. A database
+from before the totals gets them seeded once from the per-user counts (firebase_seed_totals,
+called by firebase_setup), or its stats would read empty until the next reset.
 '''
 
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
-from matplotlib import pyplot as plt
+import time
+from collections import deque
+from threading import Thread, Condition
+
+from event_log import EventLog
+
+USERS = ['ken', 'tim', 'grace', 'shelly', 'frank']
+CATEGORIES = ['bottles', 'cans', 'others']
+# name of this bin in the database
+KIOSK = 'kiosk'
+
+
+def increment(n):
+    """Realtime Database server value: add n to the current value (0 if missing)"""
+    return {'.sv': {'increment': n}}
 
 
 def firebase_setup():
@@ -25,13 +48,37 @@ def firebase_setup():
     firebase_admin.initialize_app(
         cred, {'databaseURL': 'https://guiwithkivy-48023.firebaseio.com/', })
     firebase = db.reference('/')
+    firebase_seed_totals(firebase)
     return firebase
 
 
-def firebase_reset(firebase):
+def firebase_seed_totals(firebase, kiosk=KIOSK):
+    """
+    Copy the per-user counts of a database written before the bins' totals existed into
+    _totals/<kiosk>, once. It must run before this version first writes to the database,
+    as any write creates _totals. Returns whether the totals were seeded.
+    """
+    if isinstance(firebase, EventLog) or firebase.child('_totals').get() is not None:
+        return False
+    # nothing of this version has written yet, so the tree only holds the counts
+    data = {user: counts for user, counts in (firebase.get() or {}).items()
+            if not user.startswith('_') and isinstance(counts, dict)}
+    if not data:
+        return False
+    firebase.child('_totals').child(kiosk).set(data)
+    return True
+
+
+def counter_update(user, category, amount, kiosk=KIOSK):
+    """Multi-path update entries incrementing a count, and the bin's total of it"""
+    return {user + '/' + category: increment(amount),
+            '_totals/' + kiosk + '/' + user + '/' + category: increment(amount)}
+
+
+def firebase_reset(firebase, kiosk=KIOSK):
     """
-    Reset all users and their recycling category counts to 0. 
-    Returns a dictionary of the data in the updated firebase.
+    Reset all users and their recycling category counts to 0, in one multi-path update.
+    Returns a dictionary of the data written.
     Dictionary will look like this:
     {
     'frank': {'bottles': 0, 'cans': 0, 'others': 0},
@@ -41,25 +88,27 @@ def firebase_reset(firebase):
     'tim': {'bottles': 0, 'cans': 0, 'others': 0}
     }
     """
-    users = ['ken', 'tim', 'grace', 'shelly', 'frank']
-    categories = ['bottles', 'cans', 'others']
+    data = {user: {category: 0 for category in CATEGORIES} for user in USERS}
+    if isinstance(firebase, EventLog):
+        firebase.reset()
+        return data
+    update = {user + '/' + category: 0 for user in USERS for category in CATEGORIES}
+    update['_totals/' + kiosk] = data
+    firebase.update(update)
 
-    for user in users:
-        for category in categories:
-            firebase.child(user).child(category).set(0)
+    return data
 
-    return firebase.get()
 
-
-def firebase_update(firebase, user, category, increment):
+def firebase_update(firebase, user, category, amount, confidence=None, kiosk=KIOSK):
     """
-    Updates the specified user's recycling count in the specified category by the specified amount. 
-    Returns a dictionary of the data in the updated firebase.
+    Updates the specified user's recycling count in the specified category by the specified amount,
+    atomically on the server and in one round-trip.
+    With an EventLog, the event (and the detection confidence) is only queued for the log.
     """
-    current = firebase.child(user).child(category).get()
-    firebase.child(user).child(category).set(current + increment)
-
-    return firebase.get()
+    if isinstance(firebase, EventLog):
+        firebase.append(user, category, amount, confidence)
+        return
+    firebase.update(counter_update(user, category, amount, kiosk))
 
 
 def firebase_stats(firebase):
@@ -71,35 +120,73 @@ def firebase_stats(firebase):
     The second dictionary has the recycling categories as keys and the respective category count as values.
     It will look like this:
     {'bottles': 229, 'cans': 205, 'others': 186}
+    Both are summed over the bins' totals, never over the events.
     """
-    data = firebase.get()
-    by_user_count = {user: sum(data[user].values()) for user in data.keys()}
+    if isinstance(firebase, EventLog):
+        return firebase.stats()
+
+    by_user_count = {}
     by_category_count = {}
 
-    for user in data:
-        for category in data[user]:
-            if category not in by_category_count:
-                by_category_count[category] = data[user][category]
-            else:
-                by_category_count[category] += data[user][category]
+    for bin_totals in (firebase.child('_totals').get() or {}).values():
+        for user in bin_totals:
+            for category, count in bin_totals[user].items():
+                by_user_count[user] = by_user_count.get(user, 0) + count
+                by_category_count[category] = by_category_count.get(category, 0) + count
 
     return by_user_count, by_category_count
 
 
-def firebase_random(firebase):
+def firebase_bin_stats(firebase, kiosk=KIOSK):
+    """
+    Returns a dictionary with the bin names as keys and the number of items recycled in each as values.
+    It will look like this:
+    {'kiosk': 620, 'library': 312}
+    An EventLog only holds this bin's events; they are counted under kiosk.
+    """
+    if isinstance(firebase, EventLog):
+        by_user_count, _ = firebase.stats()
+        return {kiosk: sum(by_user_count.values())}
+
+    return {kiosk: sum(sum(counts.values()) for counts in bin_totals.values())
+            for kiosk, bin_totals in (firebase.child('_totals').get() or {}).items()}
+
+
+def firebase_leaderboard(firebase, k=5, period=None, since=None):
     """
-    For testing purposes, this function will set random values to all counts in the firebase.
-    Returns a dictionary of the data in the updated firebase.
+    Returns the k users who recycled the most items as a list of (user, count), best first.
+    With an EventLog, period ('hourly', 'daily' or 'weekly') limits it to the rollup buckets
+    from the one containing since (default: now); otherwise it is since the last reset.
+    Raises ValueError for a period with a firebase reference, which only has the totals.
     """
-    users = ['ken', 'tim', 'grace', 'shelly', 'frank']
-    categories = ['bottles', 'cans', 'others']
+    if isinstance(firebase, EventLog):
+        return firebase.leaderboard(k, period, since)
+    if period is not None or since is not None:
+        raise ValueError("firebase_leaderboard: period and since need an EventLog")
 
+    by_user_count, _ = firebase_stats(firebase)
+    return sorted(by_user_count.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def firebase_random(firebase, kiosk=KIOSK):
+    """
+    For testing purposes, this function will set random values to all counts in the firebase,
+    in one multi-path update.
+    Returns a dictionary of the data written.
+    """
     from random import randint
-    for user in users:
-        for category in categories:
-            firebase.child(user).child(category).set(randint(1, 100))
+    data = {user: {category: randint(1, 100) for category in CATEGORIES} for user in USERS}
+    if isinstance(firebase, EventLog):
+        firebase.reset()
+        for user in USERS:
+            for category in CATEGORIES:
+                firebase.append(user, category, data[user][category])
+        return data
+    update = {user + '/' + category: data[user][category] for user in USERS for category in CATEGORIES}
+    update['_totals/' + kiosk] = data
+    firebase.update(update)
 
-    return firebase.get()
+    return data
 
 
 def firebase_plot(firebase):
@@ -108,6 +195,8 @@ def firebase_plot(firebase):
     The first the the statistics by user, and the second the statistics by category.
     It then uses matplotlib to plot 2 bar charts based on the data in the respective dictionaries.
     """
+    from matplotlib import pyplot as plt
+
     by_user_count, by_category_count = firebase_stats(firebase)
 
     plt.bar(range(len(by_user_count)), by_user_count.values())
@@ -123,3 +212,93 @@ def firebase_plot(firebase):
     plt.xlabel('Recyclable item category')
     plt.ylabel('Number of items recycled')
     plt.show()
+
+
+class CounterAggregator:
+    """
+    Write-behind recycling counters.
+    add() only buffers the increment locally, coalesced per user and category; a background
+    thread flushes everything buffered every `interval` seconds as a single multi-path update
+    of server-side increments. If a flush fails the increments are kept for the next one.
+    """
+
+    def __init__(self, firebase, interval=5., kiosk=KIOSK):
+        self.firebase = firebase
+        self.interval = interval
+        self.kiosk = kiosk
+        self.pending = {}
+        self.changed = Condition()
+        self.increments = 0
+        self.flushes = 0
+        self.failures = 0
+        # the most recent flushes only, so a kiosk running for months stays bounded
+        self.flush_latency = deque(maxlen=512)
+        self.stopped = False
+        self.thread = None
+
+    def add(self, user, category, amount=1):
+        with self.changed:
+            key = user + '/' + category
+            self.pending[key] = self.pending.get(key, 0) + amount
+            self.increments += 1
+
+    def start(self):
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def update(self):
+        while True:
+            with self.changed:
+                self.changed.wait(self.interval)
+                if self.stopped:
+                    return
+            self.flush()
+
+    def flush(self):
+        """Send everything buffered now; returns whether there was anything to send"""
+        with self.changed:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return False
+
+        start = time.time()
+        try:
+            update = {}
+            for key, amount in pending.items():
+                update.update(counter_update(*key.split('/'), amount, kiosk=self.kiosk))
+            self.firebase.update(update)
+        except Exception as error:
+            print("[!] Firebase flush failed, will retry:", error)
+            self.failures += 1
+            with self.changed:
+                for key, amount in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + amount
+            return False
+
+        self.flush_latency.append(time.time() - start)
+        self.flushes += 1
+        return True
+
+    def report(self):
+        """
+        Round-trips saved against the old firebase_update, which did a get, a set and
+        a full-tree get per increment, and the flush latency in seconds (over the last 512 flushes)
+        """
+        latency = sorted(self.flush_latency) or [0.]
+        return {'increments': self.increments,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'writes_saved': self.increments * 3 - self.flushes,
+                'flush_latency_p50': latency[len(latency) // 2],
+                'flush_latency_max': latency[-1]}
+
+    def stop(self):
+        """Stop the background thread and flush what is left"""
+        with self.changed:
+            self.stopped = True
+            self.changed.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
@@ -0,0 +1,248 @@
+'''
+LED strip control.
+The LEDController thread owns a frame buffer for the strip: callers only describe
+the colours they want (per pixel, per named zone, or as an animation), and the
+thread pushes them to the strip, writing only the pixels that changed and calling
+the blocking strip.show() only when something changed, at most max_fps times a second.
+MockStrip is an in-memory stand-in for the Adafruit_NeoPixel strip, with a
+realistic show() transfer time, so this can be tested and timed without hardware.
+
+Running this script compares the old per-tick LED updates with the controller on a MockStrip.
+'''
+
+import time
+from threading import Thread, Condition
+
+import numpy as np
+
+from metrics import METRICS
+
+
+def Color(red, green, blue, white=0):
+    """A 32-bit colour, packed like neopixel.Color"""
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+# the strip is wired GRB, so these are (green, red, blue) as the neopixel library sees them
+RED = Color(0, 255, 0)
+GREEN = Color(255, 0, 0)
+BLUE = Color(0, 0, 255)
+YELLOW = Color(255, 255, 0)
+OFF = Color(0, 0, 0)
+
+# pixel ranges of the strip mounted along the bins
+ZONES = {'status': range(0, 8),
+         'bottles': range(8, 15),
+         'cans': range(15, 25)}
+
+
+class MockStrip:
+    """
+    In-memory strip with the Adafruit_NeoPixel interface.
+    show() takes as long as the ws281x transfer would (30us per pixel plus the latch)
+    and keeps the shown colours in self.shown.
+    """
+
+    def __init__(self, num_pixels=25, pixel_time=30e-6, latch_time=300e-6):
+        self.pixels = np.zeros(num_pixels, dtype=np.uint32)
+        self.shown = self.pixels.copy()
+        self.show_time = num_pixels * pixel_time + latch_time
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self.pixels)
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def getPixelColor(self, n):
+        return int(self.pixels[n])
+
+    def show(self):
+        deadline = time.time() + self.show_time
+        while time.time() < deadline:
+            pass
+        self.shown[:] = self.pixels
+        self.shows += 1
+
+
+class LEDController:
+    """
+    Pushes the desired frame to the strip from its own thread, only when it changed.
+    An animation is a function of the seconds since it started, returning the next
+    frame to show, or None once it has finished; while one runs it is evaluated
+    max_fps times a second and takes precedence over set_frame/set_zone.
+    """
+
+    def __init__(self, strip, zones=ZONES, max_fps=30):
+        self.strip = strip
+        self.zones = zones
+        self.min_interval = 1. / max_fps
+        num_pixels = strip.numPixels()
+        self.desired = np.zeros(num_pixels, dtype=np.uint32)
+        # unknown until the first show, so the first frame is always pushed
+        self.shown = None
+        self.animation = None
+        self.animation_start = None
+        self.changed = Condition()
+        self.dirty = False
+        self.shows = 0
+        self.pixel_writes = 0
+        self.stopped = False
+        self.thread = None
+
+    def frame(self, fill=OFF, **zones):
+        """A new frame filled with one colour, with the given zones (name=colour) set"""
+        frame = np.full(len(self.desired), fill, dtype=np.uint32)
+        for name, colour in zones.items():
+            frame[self.zones[name].start:self.zones[name].stop] = colour
+        return frame
+
+    def set_frame(self, frame):
+        with self.changed:
+            self.desired[:] = frame
+            self.dirty = True
+            self.changed.notify()
+
+    def set_zone(self, name, colour):
+        zone = self.zones[name]
+        with self.changed:
+            self.desired[zone.start:zone.stop] = colour
+            self.dirty = True
+            self.changed.notify()
+
+    def animate(self, animation):
+        """Run an animation until it returns None (or another one replaces it)"""
+        with self.changed:
+            self.animation = animation
+            self.animation_start = time.time()
+            self.changed.notify()
+
+    def start(self):
+        self.thread = Thread(target=self.update, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def update(self):
+        last_show = 0.
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.dirty or self.animation is not None or self.stopped)
+                if self.stopped:
+                    return
+
+            # cap the show rate; changes made meanwhile are merged into one show
+            time.sleep(max(last_show + self.min_interval - time.time(), 0))
+
+            with self.changed:
+                frame = None
+                if self.animation is not None:
+                    frame = self.animation(time.time() - self.animation_start)
+                    if frame is None:
+                        # animation finished: go back to the desired frame
+                        self.animation = None
+                        self.dirty = True
+                if frame is None:
+                    frame = self.desired.copy()
+                    self.dirty = False
+
+            if self.push(frame):
+                last_show = time.time()
+            elif self.animation is not None:
+                time.sleep(self.min_interval)
+
+    def push(self, frame):
+        """Write the pixels that differ from the shown frame and show them; returns whether it did"""
+        if self.shown is None:
+            changed = np.arange(len(frame))
+        else:
+            changed = np.flatnonzero(frame != self.shown)
+        if len(changed) == 0:
+            return False
+
+        for i in changed.tolist():
+            self.strip.setPixelColor(i, int(frame[i]))
+        with METRICS.time('led_show'):
+            self.strip.show()
+
+        self.shown = frame.copy()
+        self.shows += 1
+        self.pixel_writes += len(changed)
+        return True
+
+    def stop(self, clear=True):
+        """Stop the thread, and turn the strip off if clear"""
+        with self.changed:
+            self.stopped = True
+            self.changed.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if clear:
+            self.push(np.zeros(len(self.desired), dtype=np.uint32))
+
+
+def progress_bar(progress, num_pixels):
+    """
+    Animation of a green/yellow/red progress bar filling the strip, following
+    progress(), a function returning the fraction done; finishes once full.
+    """
+    state = {'shown': 0.}
+
+    def animation(elapsed):
+        if state['shown'] >= 100:
+            return None
+        # ease towards the real progress, so the bar moves smoothly
+        target = progress() * 100
+        state['shown'] = min(target, state['shown'] + max(0.5, (target - state['shown']) / 4.))
+
+        shown = state['shown']
+        frame = np.zeros(num_pixels, dtype=np.uint32)
+        frame[:int((shown + 4.4) / 100 * num_pixels)] = RED
+        frame[:int((shown + 2.6) / 100 * num_pixels)] = YELLOW
+        frame[:int(shown / 100 * num_pixels)] = GREEN
+        return frame
+
+    return animation
+
+
+if __name__ == '__main__':
+    # 60s of 10Hz decision ticks: an item in front of the bin now and then
+    ticks = 600
+    detected = [(i // 50) % 4 == 1 for i in range(ticks)]
+
+    # old: set colours, show, reset every tick on the UI thread
+    strip = MockStrip()
+    start = time.time()
+    for can in detected:
+        if can:
+            for i in range(8):
+                strip.setPixelColor(i, RED)
+            for i in range(15, 25):
+                strip.setPixelColor(i, GREEN)
+        strip.show()
+        for i in range(strip.numPixels()):
+            strip.setPixelColor(i, RED)
+        for i in range(8):
+            strip.setPixelColor(i, GREEN)
+    old_time = time.time() - start
+    print("per-tick show   {:.2f} ms UI time per tick, {} shows".format(old_time / ticks * 1000, strip.shows))
+
+    # new: the UI thread only describes the frame
+    strip = MockStrip()
+    leds = LEDController(strip).start()
+    ui_time = 0.
+    for can in detected:
+        start = time.time()
+        if can:
+            leds.set_frame(leds.frame(RED, cans=GREEN))
+        else:
+            leds.set_frame(leds.frame(RED, status=GREEN))
+        ui_time += time.time() - start
+        time.sleep(0.001)
+    leds.stop(clear=False)
+    print("LEDController   {:.2f} ms UI time per tick, {} shows, {} pixel writes".format(
+        ui_time / ticks * 1000, strip.shows, leds.pixel_writes))
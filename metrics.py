@@ -0,0 +1,183 @@
+'''
+Lightweight latency instrumentation for the computer vision pipeline.
+Each stage of a frame's journey (capture, preprocess, predict, decode, draw,
+texture upload, LED strip) records its duration into a rolling window of recent
+samples, from which p50/p95/p99 and the stage's rate (events/sec) are reported.
+Recording is a clock read and one store into a preallocated array, cheap enough
+to leave on in production; percentiles are only computed when a report is asked for.
+
+  with METRICS.time('predict'):
+      netouts = engine.predict(input_image)
+  METRICS.record('frame_age', time.time() - frame_time)
+
+Reports are available as a dictionary (snapshot), a log line (log), Prometheus-style
+text (text), a file rewritten periodically (write) and a local HTTP endpoint (serve).
+Running this script measures the recording overhead.
+'''
+
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+import numpy as np
+
+
+class RollingHistogram:
+    """The last `window` durations (seconds) of one stage, with the times they were recorded"""
+
+    def __init__(self, window=512):
+        self.window = window
+        self.durations = np.zeros(window)
+        self.times = np.zeros(window)
+        self.count = 0
+
+    def record(self, seconds, timestamp):
+        i = self.count % self.window
+        self.durations[i] = seconds
+        self.times[i] = timestamp
+        self.count += 1
+
+    def report(self, now=None):
+        n = min(self.count, self.window)
+        if n == 0:
+            return {'count': 0, 'rate': 0., 'mean': 0., 'p50': 0., 'p95': 0., 'p99': 0.}
+
+        durations = self.durations[:n]
+        times = self.times[:n]
+        now = time.time() if now is None else now
+        span = now - times.min()
+        p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+        return {'count': self.count,
+                'rate': (n - 1) / span if n > 1 and span > 0 else 0.,
+                'mean': float(durations.mean()),
+                'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+class Metrics:
+    """A set of named RollingHistograms, created on first use"""
+
+    def __init__(self, window=512):
+        self.window = window
+        self.histograms = OrderedDict()
+        self.pending = None
+        self._lock = Lock()
+
+    def record(self, stage, seconds, timestamp=None):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, RollingHistogram(self.window))
+        timestamp = time.time() if timestamp is None else timestamp
+        histogram.record(seconds, timestamp)
+        if self.pending is not None:
+            self.pending.append((stage, seconds, timestamp))
+
+    @contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.record(stage, end - start, end)
+
+    def keep_samples(self, limit=4096):
+        """Also keep the most recent samples until drain(), to ship them to another process"""
+        self.pending = deque(maxlen=limit)
+
+    def drain(self):
+        samples = []
+        while self.pending:
+            samples.append(self.pending.popleft())
+        return samples
+
+    def merge(self, samples):
+        """Record (stage, seconds, timestamp) samples taken elsewhere, e.g. in the inference worker"""
+        for stage, seconds, timestamp in samples:
+            self.record(stage, seconds, timestamp)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            histograms = list(self.histograms.items())
+        return OrderedDict((stage, histogram.report(now)) for stage, histogram in histograms)
+
+    def summary(self):
+        """One line: p50/p95 (ms) and rate of each stage"""
+        return " | ".join("{} {:.1f}/{:.1f}ms {:.1f}/s".format(
+            stage, report['p50'] * 1000, report['p95'] * 1000, report['rate'])
+            for stage, report in self.snapshot().items())
+
+    def log(self):
+        print("[m] " + self.summary())
+
+    def text(self):
+        """Prometheus-style text exposition of every stage"""
+        lines = []
+        for stage, report in self.snapshot().items():
+            for quantile in ('p50', 'p95', 'p99'):
+                lines.append('smartbin_stage_seconds{{stage="{}",quantile="0.{}"}} {:.6f}'.format(
+                    stage, quantile[1:], report[quantile]))
+            lines.append('smartbin_stage_seconds_mean{{stage="{}"}} {:.6f}'.format(stage, report['mean']))
+            lines.append('smartbin_stage_rate{{stage="{}"}} {:.3f}'.format(stage, report['rate']))
+            lines.append('smartbin_stage_count{{stage="{}"}} {}'.format(stage, report['count']))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically replace path with the current text()"""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.text())
+        os.replace(temp_path, path)
+
+    def serve(self, port=8001, host='127.0.0.1'):
+        """Serve text() at http://host:port/metrics from a daemon thread; returns the server"""
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+# the process-wide metrics every stage records into
+METRICS = Metrics()
+
+
+if __name__ == '__main__':
+    import timeit
+
+    metrics = Metrics()
+    number = 100000
+
+    def record():
+        metrics.record('stage', 0.001)
+
+    def timed():
+        with metrics.time('stage'):
+            pass
+
+    for name, fn in [('record', record), ('time()', timed)]:
+        best = min(timeit.repeat(fn, number=number, repeat=3)) / number
+        print("{:<8} {:.2f} us per sample".format(name, best * 1e6))
+
+    best = min(timeit.repeat(metrics.snapshot, number=100, repeat=3)) / 100
+    print("snapshot {:.2f} ms".format(best * 1000))
+    print(metrics.text())
@@ -0,0 +1,148 @@
+'''
+Prebuilt model artifact cache.
+The first boot builds the Keras graph, loads the trained weights and saves the
+result as a single artifact keyed on a hash of the model configuration and the
+weights file. Later boots load that artifact directly, and the cache rebuilds
+itself whenever either input changes.
+Cold and warm start times are recorded so startup regressions can be tracked;
+running this script prints that history.
+'''
+
+import hashlib
+import json
+import os
+import time
+
+from metrics import METRICS
+
+CACHE_DIR = "data/cache"
+STARTUP_LOG = "startup_times.json"
+
+
+def cache_key(config_path, weights_path):
+    """Hash of the model configuration and the weights file contents"""
+    digest = hashlib.sha1()
+
+    with open(config_path, 'rb') as config_buffer:
+        digest.update(config_buffer.read())
+
+    with open(weights_path, 'rb') as weights_buffer:
+        for chunk in iter(lambda: weights_buffer.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def load_model(config_path, weights_path, tflite_path=None, cache_dir=CACHE_DIR):
+    """
+    Returns a ready-to-run ObjectDetection model, from the cache if possible.
+    Builds and caches the artifact on a cache miss.
+    If tflite_path is given, the exported model is run on a TFLiteEngine instead.
+    """
+    from object_detection_model import ObjectDetection
+
+    start = time.time()
+
+    with open(config_path) as config_buffer:
+        config = json.load(config_buffer)['model']
+
+    if tflite_path is not None:
+        from engines import TFLiteEngine
+        print("[i] Loading TensorFlow Lite model from", tflite_path)
+        return ObjectDetection.from_engine(TFLiteEngine(tflite_path),
+                                           input_size=config['input_size'],
+                                           labels=config['labels'],
+                                           max_box_per_image=config['max_box_per_image'],
+                                           anchors=config['anchors'])
+
+    key = cache_key(config_path, weights_path)
+    artifact_path = os.path.join(cache_dir, key + '.h5')
+
+    model = None
+    if os.path.exists(artifact_path):
+        print("[i] Loading cached model artifact", artifact_path)
+        try:
+            model = ObjectDetection.from_artifact(artifact_path,
+                                                  input_size=config['input_size'],
+                                                  labels=config['labels'],
+                                                  max_box_per_image=config['max_box_per_image'],
+                                                  anchors=config['anchors'])
+            kind = 'warm'
+        except Exception as error:
+            # e.g. truncated by a crash in an older version; rebuild it below
+            print("[!] Cached model artifact is unusable, rebuilding:", error)
+            os.remove(artifact_path)
+
+    if model is None:
+        print("[i] No cached model artifact, building model... This will take a while... (< 2 mins)")
+        model = ObjectDetection(backend=config['backend'],
+                                input_size=config['input_size'],
+                                labels=config['labels'],
+                                max_box_per_image=config['max_box_per_image'],
+                                anchors=config['anchors'],
+                                backend_weights=None)
+        model.load_weights(weights_path)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file and rename it into place, so a power loss
+        # mid-save never leaves a truncated artifact under the final name
+        temp_path = os.path.join(cache_dir, key + '.partial.h5')
+        model.save_artifact(temp_path)
+        os.replace(temp_path, artifact_path)
+        _remove_stale_artifacts(cache_dir, keep=artifact_path)
+        kind = 'cold'
+
+    record_startup(cache_dir, key, kind, time.time() - start)
+    METRICS.record('model_load', time.time() - start)
+    return model
+
+
+def expected_load_time(cache_dir=CACHE_DIR, default=110.):
+    """Duration of the most recent model load, for the loading progress bar"""
+    history = read_startup_log(cache_dir)
+    if not history:
+        return default
+    return history[-1]['seconds']
+
+
+def read_startup_log(cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, STARTUP_LOG)
+    if not os.path.exists(path):
+        return []
+    with open(path) as log_buffer:
+        return json.load(log_buffer)
+
+
+def record_startup(cache_dir, key, kind, seconds, max_entries=200):
+    history = read_startup_log(cache_dir)
+    history.append({'time': time.time(), 'key': key, 'kind': kind, 'seconds': seconds})
+
+    with open(os.path.join(cache_dir, STARTUP_LOG), 'w') as log_buffer:
+        json.dump(history[-max_entries:], log_buffer, indent=1)
+
+    print("[i] Model took", seconds, "seconds to load ({} start)".format(kind))
+
+
+def _remove_stale_artifacts(cache_dir, keep):
+    """Only the artifact for the current config and weights is kept"""
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.h5') and path != keep:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    history = read_startup_log()
+    if not history:
+        print("No startup times recorded in", CACHE_DIR)
+
+    for kind in ('cold', 'warm'):
+        times = [entry['seconds'] for entry in history if entry['kind'] == kind]
+        if times:
+            print("{} starts: {}  last {:.1f}s  best {:.1f}s  mean {:.1f}s".format(
+                kind, len(times), times[-1], min(times), sum(times) / len(times)))
+
+    for entry in history[-10:]:
+        print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])),
+              entry['kind'], entry['key'][:8], "{:.1f}s".format(entry['seconds']))
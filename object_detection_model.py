@@ -1,9 +1,12 @@
 import numpy as np
 import cv2
-from keras.models import Model
-from keras.layers import Input, Conv2D, Reshape, Lambda
-from keras.applications.mobilenet import MobileNet
 from box_utils import decode_netout, compute_overlap, compute_ap
+from preprocessing import normalize_into
+from metrics import METRICS
+from engines import KerasEngine
+
+# Keras is imported only where a graph is built or loaded, so that models
+# running on a lightweight engine (see engines.py) never pay for it
 
 class MobileNetFeatureExtractor:
     """
@@ -17,11 +20,18 @@ class MobileNetFeatureExtractor:
     https://github.com/experiencor/keras-yolo2/blob/master/backend.py
     """
 
-    def __init__(self, input_size):
+    def __init__(self, input_size, backend_weights="data/mobilenet_backend.h5"):
+        from keras.models import Model
+        from keras.layers import Input
+        from keras.applications.mobilenet import MobileNet
+
         input_image = Input(shape=(input_size, input_size, 3))
 
-        mobilenet = MobileNet(input_shape=(224,224,3), include_top=False)
-        mobilenet.load_weights("data/mobilenet_backend.h5")
+        # no pretrained weights are downloaded; skip the backend weights too
+        # (backend_weights=None) when full detector weights are loaded afterwards
+        mobilenet = MobileNet(input_shape=(224,224,3), include_top=False, weights=None)
+        if backend_weights is not None:
+            mobilenet.load_weights(backend_weights)
         x = mobilenet(input_image)
 
         self.feature_extractor = Model(input_image, x)  
@@ -43,15 +53,13 @@ class ObjectDetection(object):
                        input_size, 
                        labels,
                        max_box_per_image,
-                       anchors):
+                       anchors,
+                       backend_weights="data/mobilenet_backend.h5",
+                       summary=True):
+        from keras.models import Model
+        from keras.layers import Input, Conv2D, Reshape, Lambda
 
-        self.input_size = input_size
-        self.labels   = list(labels)
-        self.nb_class = len(self.labels)
-        self.nb_box   = len(anchors)//2
-        self.class_wt = np.ones(self.nb_class, dtype='float32')
-        self.anchors  = anchors
-        self.max_box_per_image = max_box_per_image
+        self._init_config(input_size, labels, max_box_per_image, anchors)
 
         # =======================================
         # Two inputs:
@@ -66,7 +74,7 @@ class ObjectDetection(object):
         # Feature extraction layer
         # ========================
 
-        self.feature_extractor = MobileNetFeatureExtractor(self.input_size)
+        self.feature_extractor = MobileNetFeatureExtractor(self.input_size, backend_weights)
 
         self.grid_h, self.grid_w = self.feature_extractor.get_output_shape()
 
@@ -98,7 +106,61 @@ class ObjectDetection(object):
         self.model = Model([input_image, self.true_boxes], output)
 
         # print a summary of the whole model
-        self.model.summary()
+        if summary:
+            self.model.summary()
+
+        self.engine = KerasEngine(self.model, max_box_per_image)
+
+    def _init_config(self, input_size, labels, max_box_per_image, anchors):
+        self.input_size = input_size
+        self.labels   = list(labels)
+        self.nb_class = len(self.labels)
+        self.nb_box   = len(anchors)//2
+        self.class_wt = np.ones(self.nb_class, dtype='float32')
+        self.anchors  = anchors
+        self.max_box_per_image = max_box_per_image
+
+        # input tensors are reused between calls, keyed on batch size
+        self._batch_buffers = {}
+
+    @classmethod
+    def from_artifact(cls, path, input_size, labels, max_box_per_image, anchors):
+        """
+        Load a ready-to-run model saved with save_artifact.
+        Skips graph construction from scratch and the separate backend/detector weight loads.
+        """
+        from keras.models import load_model
+
+        self = cls.__new__(cls)
+        self._init_config(input_size, labels, max_box_per_image, anchors)
+
+        self.feature_extractor = None
+        self.model = load_model(path, compile=False)
+        self.true_boxes = self.model.inputs[1]
+        self.grid_h, self.grid_w = self.model.output_shape[1:3]
+
+        self.engine = KerasEngine(self.model, max_box_per_image)
+        return self
+
+    @classmethod
+    def from_engine(cls, engine, input_size, labels, max_box_per_image, anchors):
+        """
+        Wrap an inference engine (e.g. engines.TFLiteEngine) running an exported model.
+        No Keras graph is built, so only predict/predict_batch are available.
+        """
+        self = cls.__new__(cls)
+        self._init_config(input_size, labels, max_box_per_image, anchors)
+
+        self.feature_extractor = None
+        self.model = None
+        self.grid_h, self.grid_w = engine.output_shape[1:3]
+
+        self.engine = engine
+        return self
+
+    def save_artifact(self, path):
+        """Serialise graph and weights together, for ObjectDetection.from_artifact"""
+        self.model.save(path, include_optimizer=False)
 
     def load_weights(self, weight_path):
         self.model.load_weights(weight_path)
@@ -112,15 +174,36 @@ class ObjectDetection(object):
     def to_json(self, path):
         return self.model.to_json()
 
+    def _get_batch_buffer(self, batch_size):
+        """Return the preallocated input tensor for a batch size"""
+        if batch_size not in self._batch_buffers:
+            self._batch_buffers[batch_size] = np.zeros(
+                (batch_size, self.input_size, self.input_size, 3), dtype='float32')
+        return self._batch_buffers[batch_size]
+
     def predict(self, image):
-        image_h, image_w, _ = image.shape
-        image = self.feature_extractor.normalize(image)
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images, batch_size=None):
+        """
+        Run inference on a list of images, returning one Detections per image.
+        Images are pushed through the network batch_size at a time (default: all at once).
+        """
+        batch_size = batch_size or len(images)
+        results = []
+
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            input_image = self._get_batch_buffer(len(chunk))
+
+            with METRICS.time('preprocess'):
+                for i, image in enumerate(chunk):
+                    normalize_into(image, input_image[i])
 
-        input_image = image[:,:,::-1]
-        input_image = np.expand_dims(input_image, 0)
-        dummy_array = np.zeros((1,1,1,1,self.max_box_per_image,4))
+            with METRICS.time('predict'):
+                netouts = self.engine.predict(input_image)
 
-        netout = self.model.predict([input_image, dummy_array])[0]
-        boxes  = decode_netout(netout, self.anchors, self.nb_class)
+            with METRICS.time('decode'):
+                results.extend([decode_netout(netout, self.anchors, self.nb_class) for netout in netouts])
 
-        return boxes
+        return results
@@ -0,0 +1,225 @@
+'''
+Frame pacing for the UI thread.
+Instead of one fixed-rate tick doing everything, each stage of MainView (display,
+box overlay, decision logic, LED strip, and the inference cadence) is a Stage
+with its own interval and time budget, run by one FramePacer off a fast Kivy clock.
+The FramePacer adapts under load:
+  1. a stage that keeps overrunning its budget is slowed down
+  2. when the UI thread is saturated (busy most of the time, or its clock ticks
+     arrive late because the CPU is busy elsewhere) skippable stages are skipped
+     and the least important stage that can still slow down is slowed down
+  3. once load drops, slowed stages are restored, most important first
+Every change is recorded in FramePacer.decisions and printed with log().
+
+Running this script simulates a load spike and prints the decisions taken.
+'''
+
+import time
+from collections import deque
+
+
+class Stage:
+    """
+    One periodic piece of UI work.
+    callback:     called as callback(dt) when the stage is due; None for a stage that
+                  only has its interval managed (e.g. the inference cadence)
+    interval:     target seconds between runs
+    budget:       seconds a run may take before it counts as an overrun
+    max_interval: slowest the stage may be paced to under load
+    priority:     higher is more important; under load the lowest priority is slowed first
+    skippable:    the stage may be skipped outright while the UI thread is saturated
+    on_interval:  called with the new interval whenever the pacer changes it
+    """
+
+    def __init__(self, name, callback, interval, budget=None, max_interval=None,
+                 priority=0, skippable=False, on_interval=None):
+        self.name = name
+        self.callback = callback
+        self.target_interval = interval
+        self.interval = interval
+        self.budget = budget if budget is not None else interval / 2.
+        self.max_interval = max_interval if max_interval is not None else interval * 4
+        self.priority = priority
+        self.skippable = skippable
+        self.on_interval = on_interval
+        self.next_time = 0.
+        self.last_run = None
+        self.runs = 0
+        self.skips = 0
+        self.overruns = 0
+        self.duration = 0.  # running mean of the last few runs
+        self.busy = 0.  # total time spent in the callback
+
+    def set_interval(self, interval):
+        self.interval = min(max(interval, self.target_interval), self.max_interval)
+        if self.on_interval is not None:
+            self.on_interval(self.interval)
+
+    def run(self, now):
+        dt = now - self.last_run if self.last_run is not None else self.interval
+        self.last_run = now
+        start = time.time()
+        self.callback(dt)
+        duration = time.time() - start
+
+        self.runs += 1
+        self.busy += duration
+        self.duration += (duration - self.duration) * 0.2
+        if duration > self.budget:
+            self.overruns += 1
+        # keep to the schedule, but never try to catch up on missed runs
+        self.next_time = max(self.next_time + self.interval, now)
+        return duration
+
+
+class FramePacer:
+    """
+    Runs Stages from a fast clock callback and adapts their intervals to the load.
+    resolution:    seconds between clock ticks (the finest interval a stage can have)
+    load_target:   fraction of wall time the UI thread may spend in stages
+    adapt_interval: seconds between adaptation decisions
+    """
+
+    def __init__(self, resolution=0.02, load_target=0.6, adapt_interval=1.0):
+        self.resolution = resolution
+        self.load_target = load_target
+        self.adapt_interval = adapt_interval
+        self.stages = []
+        self.decisions = deque(maxlen=100)
+        self.saturated = False
+        self.load = 0.
+        self.lateness = 0.
+        self._busy = 0.
+        self._window_start = None
+        self._lateness_sum = 0.
+        self._ticks = 0
+
+    def add(self, stage):
+        self.stages.append(stage)
+        self.stages.sort(key=lambda s: -s.priority)
+        if stage.on_interval is not None:
+            stage.on_interval(stage.interval)
+        return stage
+
+    def stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def tick(self, dt=None):
+        """Run every due stage, most important first; pass as the Kivy clock callback"""
+        now = time.time()
+        if self._window_start is None:
+            self._window_start = now
+        if dt is not None:
+            self._lateness_sum += max(dt - self.resolution, 0.)
+            self._ticks += 1
+
+        for stage in self.stages:
+            if stage.callback is None or now < stage.next_time:
+                continue
+            if self.saturated and stage.skippable:
+                stage.skips += 1
+                stage.next_time = now + stage.interval
+                continue
+            self._busy += stage.run(now)
+
+        if now - self._window_start >= self.adapt_interval:
+            self._adapt(now)
+
+    def _decide(self, now, stage, action, interval, reason):
+        old = stage.interval
+        stage.set_interval(interval)
+        if stage.interval != old:
+            self.decisions.append({'time': now, 'stage': stage.name, 'action': action,
+                                   'interval': stage.interval, 'previous': old, 'reason': reason})
+
+    def _adapt(self, now):
+        window = now - self._window_start
+        self.load = self._busy / window
+        self.lateness = self._lateness_sum / max(self._ticks, 1)
+        self._busy, self._lateness_sum, self._ticks = 0., 0., 0
+        self._window_start = now
+
+        # ticks arriving more than a whole tick late mean the CPU is busy elsewhere;
+        # leaving saturation needs a clear margin, so the pacer does not flap
+        if self.saturated:
+            saturated = self.load > self.load_target * 0.8 or self.lateness > self.resolution / 2
+        else:
+            saturated = self.load > self.load_target or self.lateness > self.resolution
+        if saturated != self.saturated:
+            self.decisions.append({'time': now, 'stage': None,
+                                   'action': 'saturated' if saturated else 'recovered',
+                                   'load': self.load, 'lateness': self.lateness})
+        self.saturated = saturated
+
+        # a stage that keeps overrunning its own budget is slowed regardless of load
+        for stage in self.stages:
+            if stage.callback is not None and stage.duration > stage.budget:
+                self._decide(now, stage, 'slow', stage.interval * 1.5, 'over budget')
+
+        if saturated:
+            for stage in reversed(self.stages):
+                if stage.interval < stage.max_interval:
+                    self._decide(now, stage, 'slow', stage.interval * 1.5, 'saturated')
+                    break
+        elif self.load < self.load_target / 2:
+            for stage in self.stages:
+                if stage.interval > stage.target_interval and stage.duration <= stage.budget:
+                    self._decide(now, stage, 'restore', stage.interval / 1.5, 'recovered')
+                    break
+
+    def report(self):
+        """Current load, lateness and saturation, and per-stage pacing"""
+        return {'load': self.load,
+                'lateness': self.lateness,
+                'saturated': self.saturated,
+                'stages': {stage.name: {'interval': stage.interval,
+                                        'target_interval': stage.target_interval,
+                                        'runs': stage.runs,
+                                        'skips': stage.skips,
+                                        'overruns': stage.overruns,
+                                        'duration': stage.duration}
+                           for stage in self.stages}}
+
+    def log(self):
+        report = self.report()
+        print("[u] Pacing: load {:.0%}, ticks {:.0f}ms late{}".format(
+            report['load'], report['lateness'] * 1000, ", saturated" if report['saturated'] else ""))
+        for name, stage in report['stages'].items():
+            print("[u]   {:<10} every {:.0f}ms (target {:.0f}ms), {} runs, {} skipped, {} over budget, {:.1f}ms/run".format(
+                name, stage['interval'] * 1000, stage['target_interval'] * 1000,
+                stage['runs'], stage['skips'], stage['overruns'], stage['duration'] * 1000))
+
+
+if __name__ == '__main__':
+    # simulate MainView's stages with busy-wait costs, and a load spike in the middle
+    spike = {'on': False}
+
+    def work(seconds):
+        def callback(dt):
+            deadline = time.time() + seconds * (4 if spike['on'] else 1)
+            while time.time() < deadline:
+                pass
+        return callback
+
+    pacer = FramePacer(resolution=0.01, adapt_interval=0.5)
+    pacer.add(Stage('decision', work(0.002), 0.1, priority=3))
+    pacer.add(Stage('leds', work(0.001), 0.1, priority=2))
+    pacer.add(Stage('display', work(0.008), 0.05, priority=1))
+    pacer.add(Stage('overlay', work(0.004), 0.05, priority=0, skippable=True))
+    pacer.add(Stage('inference', None, 0.1, max_interval=1.0, priority=-1))
+
+    start = last_tick = time.time()
+    while time.time() - start < 12:
+        spike['on'] = 4 < time.time() - start < 8
+        tick_start = time.time()
+        pacer.tick(tick_start - last_tick)
+        last_tick = tick_start
+        time.sleep(max(pacer.resolution - (time.time() - tick_start), 0))
+
+    for decision in pacer.decisions:
+        print("{:5.1f}s".format(decision['time'] - start),
+              {k: (round(v, 3) if isinstance(v, float) else v) for k, v in decision.items() if k != 'time'})
+    pacer.log()
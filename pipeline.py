@@ -0,0 +1,221 @@
+'''
+The SmartBin computer vision pipeline as an importable object:
+capture -> inference -> tracking -> decision, with no Kivy or LED hardware.
+SmartBinApp.py drives it from the UI; run_headless() drives it on its own and
+emits every new detection result as one JSON line, for sensor deployments
+and benchmarking. Heavy modules (Keras/TensorFlow, picamera, the worker process)
+are only imported when the configuration needs them.
+
+  python3 pipeline.py --source synthetic --duration 30 > detections.jsonl
+'''
+
+import json
+import sys
+import time
+
+from events import DetectionEvents
+from tracking import Tracker
+
+# the labels the bin reacts to; anything else detected is a user
+RECYCLABLES = ("can", "bottle")
+
+
+class Pipeline:
+    """
+    Frame source, inference (in a thread, or a worker process) and box tracking.
+    start() opens everything and runs the self-test, raising on failure;
+    add_startup_tasks() does the same as part of a larger StartupGraph.
+    """
+
+    def __init__(self, config_path="data/config.json", weights_path="data/best_weights_11.h5",
+                 tflite_path=None, frame_source="picamera", inference_process=False):
+        with open(config_path) as config_buffer:
+            self.config = json.load(config_buffer)
+
+        self.config_path = config_path
+        self.weights_path = weights_path
+        self.tflite_path = tflite_path
+        self.frame_source = frame_source
+        self.inference_process = inference_process
+        self.labels = self.config['model']['labels']
+        self.input_size = self.config['model']['input_size']
+
+        # boxes follow the video between detections
+        self.tracker = Tracker(len(self.labels))
+        # what is in front of the bin, debounced over the last few detection results
+        self.events = DetectionEvents(self.labels, RECYCLABLES)
+        self.source = None
+        self.pred = None
+        self.detection_time = None
+        self.inference = 0
+
+    def start(self, history_path=None):
+        """Start the pipeline on its own, with its startup tasks run concurrently"""
+        from startup import StartupGraph
+
+        graph = StartupGraph(history_path)
+        self.add_startup_tasks(graph)
+        graph.run()
+        return self
+
+    def add_startup_tasks(self, graph):
+        """
+        Add the pipeline's startup tasks to a StartupGraph:
+          camera:    open the frame source and wait for its first frame
+          model:     load the model (or wait for the worker process to load it)
+          self_test: run one inference, then start the inference stream
+        In worker mode the worker is forked right away, before any startup thread exists.
+        """
+        import model_cache
+
+        if self.inference_process:
+            # fork the worker before the camera is opened; it loads the model and
+            # runs its own self-test, so the model never lives in this process
+            from worker import InferenceWorker
+            print("[i] Starting inference worker process", file=sys.stderr)
+            self.pred = InferenceWorker(model_cache.load_model,
+                                        (self.config_path, self.weights_path, self.tflite_path),
+                                        (self.input_size, self.input_size, 3),
+                                        len(self.labels)).start(wait=False)
+
+        graph.add('camera', self.start_source, weight=3.)
+        graph.add('model', self.load_model, weight=model_cache.expected_load_time())
+        graph.add('self_test', self.start_inference, deps=('camera', 'model'), weight=5.)
+
+    def start_source(self):
+        """Open the frame source; returns its first frame"""
+        from camera import open_source
+
+        # the camera captures RGB frames at exactly the model's input size
+        print("[c] Starting video capture from", self.frame_source, file=sys.stderr)
+        self.source = open_source(self.frame_source, resolution=(self.input_size, self.input_size)).start()
+
+        latest = self.source.read_latest(timeout=10)  # read one frame from the stream
+        if latest is None:
+            raise RuntimeError("No frame from " + self.frame_source + " within 10s")
+        return latest[2]
+
+    def load_model(self):
+        if self.inference_process:
+            # the worker self-tests before reporting ready
+            self.pred.wait_ready()
+            return None
+
+        import model_cache
+        print("[i] Loading model with weights from", self.weights_path, file=sys.stderr)
+        return model_cache.load_model(self.config_path, self.weights_path, self.tflite_path)
+
+    def start_inference(self, frame, model):
+        """Self-test the model on a frame, then start the inference stream"""
+        print("[i] Running self-test", file=sys.stderr)
+        if self.inference_process:
+            # start feeding the (already self-tested) worker frames
+            self.source.ring = self.pred.ring
+        else:
+            from inference import InferenceLoop
+            model.predict(frame)  # get bounding boxes
+            # if previous line succeded, our model is functional; start the predictions stream
+            self.pred = InferenceLoop(model, self.source).start()
+        print("[+] Self-test: OK", file=sys.stderr)
+
+    def update(self):
+        """
+        Feed the newest detections (if any) to the tracker and the event stream,
+        whose subscribers are called from here; returns the new events, or None
+        if there were no new detections.
+        Each inference is one vote in the event stream: detections re-stamped for
+        an unchanged frame only update the tracker.
+        """
+        detection_time, detections, inference = self.pred.read_inference()
+        if detection_time is None or detection_time == self.detection_time:
+            return None
+        self.detection_time = detection_time
+        self.tracker.update(detections, detection_time)
+        if inference == self.inference:
+            return []
+        self.inference = inference
+        return self.events.update(detections, detection_time)
+
+    def detections(self, timestamp=None):
+        """
+        Tracked detections, extrapolated to timestamp (e.g. the time of the frame on screen);
+        by default at the time of the latest detections
+        """
+        return self.tracker.read(self.detection_time if timestamp is None else timestamp)
+
+    def decide(self, detections):
+        """The set of recyclables among the detected labels"""
+        return set(self.labels[i] for i in detections.labels) & set(RECYCLABLES)
+
+    def collect_metrics(self):
+        if self.inference_process:
+            self.pred.collect_metrics()
+
+    def stop(self):
+        if self.pred is not None:
+            self.pred.stop()
+        if self.source is not None:
+            self.source.stop()
+
+
+def detections_record(pipeline, detections, timestamp, events=()):
+    """One detection result, and the events it caused, as a JSON-serialisable dictionary"""
+    return {'time': round(timestamp, 3),
+            'recyclables': sorted(pipeline.decide(detections)),
+            'events': [{'kind': event.kind, 'label': event.label, 'duration': round(event.duration, 3),
+                        'confidence': round(event.confidence, 3)}
+                       for event in events],
+            'boxes': [{'label': pipeline.labels[label],
+                       'score': round(score, 3),
+                       'box': [round(c, 4) for c in coords]}
+                      for coords, label, score in zip(detections.coords.tolist(),
+                                                      detections.labels.tolist(),
+                                                      detections.scores.tolist())]}
+
+
+def run_headless(pipeline, output=sys.stdout, duration=None, interval=0.05):
+    """
+    Write every new detection result of a started pipeline to output as a JSON line,
+    for duration seconds (or until interrupted). Returns the number of lines written.
+    """
+    start = time.time()
+    lines = 0
+
+    while duration is None or time.time() - start < duration:
+        # the inference worker sends its stage timings about once a second: read them,
+        # or they pile up in the queue
+        pipeline.collect_metrics()
+        events = pipeline.update()
+        if events is not None:
+            record = detections_record(pipeline, pipeline.detections(pipeline.detection_time),
+                                       pipeline.detection_time, events)
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            lines += 1
+        else:
+            time.sleep(interval)
+
+    return lines
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the detection pipeline headless, writing JSON lines')
+    parser.add_argument('--config', default='data/config.json')
+    parser.add_argument('--weights', default='data/best_weights_11.h5')
+    parser.add_argument('--tflite', default=None)
+    parser.add_argument('--source', default='picamera', help='picamera, synthetic, images:<folder> or video:<path>')
+    parser.add_argument('--process', action='store_true', help='run inference in a worker process')
+    parser.add_argument('--duration', type=float, default=None)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args.config, args.weights, args.tflite, args.source, args.process)
+    try:
+        pipeline.start()
+        lines = run_headless(pipeline, duration=args.duration)
+        print("[i] Wrote {} detection results".format(lines), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
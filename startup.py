@@ -0,0 +1,179 @@
+'''
+Concurrent startup.
+Startup is a graph of named tasks, each run on its own thread as soon as the tasks
+it depends on have finished, so independent work (camera warm-up, UI imports,
+model loading) overlaps instead of running one after another.
+Progress is the share of the expected startup work that is done: each task is
+weighted by how long it took on the last boot (kept in history_path), and running
+tasks get credit for their elapsed time, capped below their full weight.
+After a run, critical_path() gives the chain of tasks that determined the total
+startup time, i.e. the stages worth optimising next.
+
+Running this script runs a simulated startup graph and reports its critical path.
+'''
+
+import json
+import os
+import sys
+import time
+from threading import Thread, Condition
+
+
+class Task:
+    def __init__(self, name, fn, deps, weight):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.weight = weight
+        self.start = None
+        self.end = None
+        self.result = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.end - self.start if self.end is not None else None
+
+
+class StartupGraph:
+    """
+    Tasks are added with add(name, fn, deps, weight); fn is called with the results
+    of its dependencies, in the order given. run() runs them all and returns
+    a dictionary of task name -> result, or raises RuntimeError if any task failed.
+    """
+
+    def __init__(self, history_path=None, log=True):
+        self.history_path = history_path
+        self.log = log
+        self.tasks = {}
+        self.order = []
+        self.history = {}
+        self.started = None
+        self.finished = None
+        self._condition = Condition()
+
+        if history_path is not None and os.path.exists(history_path):
+            try:
+                with open(history_path) as history_buffer:
+                    self.history = json.load(history_buffer)
+            except ValueError:
+                self.history = {}
+
+    def add(self, name, fn, deps=(), weight=1.):
+        """weight: expected seconds, used until the task has a recorded duration"""
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError("Task {} depends on unknown task {}".format(name, dep))
+        self.tasks[name] = Task(name, fn, deps, self.history.get(name, weight))
+        self.order.append(name)
+        return self
+
+    def _ready(self, task):
+        return task.start is None and all(self.tasks[dep].end is not None for dep in task.deps)
+
+    def _run_task(self, task):
+        try:
+            task.result = task.fn(*[self.tasks[dep].result for dep in task.deps])
+        except Exception as error:
+            task.error = error
+
+        with self._condition:
+            task.end = time.time()
+            if self.log:
+                print("[s] {} {} in {:.1f}s ({:.0%} started up)".format(
+                    task.name, "failed" if task.error else "done", task.duration, self.progress()),
+                    file=sys.stderr)
+            self._condition.notify_all()
+
+    def run(self):
+        self.started = time.time()
+        with self._condition:
+            while True:
+                failed = [task for task in self.tasks.values() if task.error is not None]
+                if failed:
+                    # let running tasks finish, so nothing is left half-started
+                    self._condition.wait_for(lambda: all(
+                        task.end is not None for task in self.tasks.values() if task.start is not None))
+                    raise RuntimeError("Startup task {} failed: {!r}".format(failed[0].name, failed[0].error))
+
+                if all(task.end is not None for task in self.tasks.values()):
+                    break
+
+                for name in self.order:
+                    task = self.tasks[name]
+                    if self._ready(task):
+                        task.start = time.time()
+                        thread = Thread(target=self._run_task, args=(task,), name='startup-' + name)
+                        thread.daemon = True
+                        thread.start()
+
+                self._condition.wait()
+
+        self.finished = time.time()
+        self._save_history()
+        return {name: task.result for name, task in self.tasks.items()}
+
+    def progress(self):
+        """Fraction of the expected startup work done, between 0 and 1"""
+        if self.finished is not None:
+            return 1.
+        now = time.time()
+        total = sum(task.weight for task in self.tasks.values()) or 1.
+        done = 0.
+        for task in self.tasks.values():
+            if task.end is not None:
+                done += task.weight
+            elif task.start is not None:
+                done += min(now - task.start, task.weight * 0.95)
+        return min(done / total, 1.)
+
+    def critical_path(self):
+        """The chain of (task name, seconds) that ended last, from the first task to the last"""
+        finished = [task for task in self.tasks.values() if task.end is not None]
+        if not finished:
+            return []
+
+        path = []
+        task = max(finished, key=lambda t: t.end)
+        while task is not None:
+            path.append((task.name, task.duration))
+            deps = [self.tasks[dep] for dep in task.deps]
+            task = max(deps, key=lambda t: t.end) if deps else None
+        return path[::-1]
+
+    def report(self):
+        path = self.critical_path()
+        print("[s] Started up in {:.1f}s; critical path: {}".format(
+            self.finished - self.started,
+            " -> ".join("{} {:.1f}s".format(name, seconds) for name, seconds in path)),
+            file=sys.stderr)
+
+    def _save_history(self):
+        if self.history_path is None:
+            return
+        self.history.update((name, round(task.duration, 2)) for name, task in self.tasks.items())
+        directory = os.path.dirname(self.history_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.history_path, 'w') as history_buffer:
+            json.dump(self.history, history_buffer, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    def sleeper(seconds, value=None):
+        def fn(*args):
+            time.sleep(seconds)
+            return value
+        return fn
+
+    graph = StartupGraph()
+    graph.add('camera', sleeper(1.0), weight=1.)
+    graph.add('ui', sleeper(1.5), weight=1.5)
+    graph.add('model', sleeper(3.0), weight=3.)
+    graph.add('self_test', sleeper(0.5), deps=('camera', 'model'), weight=0.5)
+    graph.add('app', sleeper(0.2), deps=('ui', 'self_test'), weight=0.2)
+
+    start = time.time()
+    graph.run()
+    print("sequential {:.1f}s, concurrent {:.1f}s".format(1.0 + 1.5 + 3.0 + 0.5 + 0.2, time.time() - start))
+    graph.report()
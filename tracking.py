@@ -0,0 +1,138 @@
+'''
+Tracking of detected objects between inferences.
+Detections arrive at around 1 FPS while the UI renders at around 16 FPS, so each
+detected box is given a constant-velocity Kalman filter. Every displayed frame
+reads the boxes carried forward to the display time, and fresh detections are
+re-associated with the existing tracks by IoU.
+'''
+
+import numpy as np
+
+from box_utils import Detections, compute_overlap
+
+
+class KalmanBoxTrack:
+    """
+    Constant-velocity Kalman filter for one box.
+    State: centre x, centre y, width, height and their velocities (unit: image width/height, per second).
+    """
+
+    def __init__(self, coords, score, label, timestamp,
+                 measurement_var=4e-4, velocity_var=0.1, process_var=0.05):
+        self.state = np.zeros(8)
+        self.state[:4] = _to_centre(coords)
+        self.covariance = np.diag([measurement_var] * 4 + [velocity_var] * 4)
+        self.measurement_cov = np.eye(4) * measurement_var
+        self.process_var = process_var
+        self.score = score
+        self.label = label
+        self.timestamp = timestamp
+        self.misses = 0
+
+    def _transition(self, dt):
+        transition = np.eye(8)
+        transition[:4, 4:] = np.eye(4) * dt
+        return transition
+
+    def predict(self, timestamp):
+        """Advance the filter to timestamp"""
+        dt = max(timestamp - self.timestamp, 0.)
+        transition = self._transition(dt)
+        self.state = transition.dot(self.state)
+        self.covariance = transition.dot(self.covariance).dot(transition.T) + np.eye(8) * self.process_var * dt
+        self.timestamp = max(timestamp, self.timestamp)
+
+    def correct(self, coords, score, label):
+        """Fold in a matched detection (the filter must already be advanced to its time)"""
+        innovation = _to_centre(coords) - self.state[:4]
+        innovation_cov = self.covariance[:4, :4] + self.measurement_cov
+        gain = self.covariance[:, :4].dot(np.linalg.inv(innovation_cov))
+        self.state = self.state + gain.dot(innovation)
+        self.covariance = self.covariance - gain.dot(self.covariance[:4, :])
+        self.score = score
+        self.label = label
+        self.misses = 0
+
+    def coords_at(self, timestamp, max_extrapolation):
+        """Box extrapolated to timestamp, without changing the filter"""
+        dt = min(max(timestamp - self.timestamp, 0.), max_extrapolation)
+        centre = self.state[:4] + self.state[4:] * dt
+        return _from_centre(centre)
+
+
+class Tracker:
+    """
+    Carries detected boxes forward between inferences.
+      1. update(detections, timestamp): a fresh detection result for the frame captured at timestamp
+      2. read(timestamp): Detections with every track extrapolated to timestamp
+    Tracks that go unmatched for more than max_misses updates are dropped.
+    """
+
+    def __init__(self, nb_class, iou_threshold=0.3, max_misses=1, max_extrapolation=1.5):
+        self.nb_class = nb_class
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.max_extrapolation = max_extrapolation
+        self.tracks = []
+        self.timestamp = None
+
+    def update(self, detections, timestamp):
+        if timestamp == self.timestamp:
+            return
+        self.timestamp = timestamp
+
+        for track in self.tracks:
+            track.predict(timestamp)
+
+        matched_tracks, matched_detections = set(), set()
+
+        if self.tracks and len(detections):
+            track_coords = np.array([_from_centre(track.state[:4]) for track in self.tracks])
+            overlaps = compute_overlap(track_coords, detections.coords.astype(np.float64))
+            # only boxes of the same class may be associated
+            track_labels = np.array([track.label for track in self.tracks])
+            overlaps[track_labels[:, np.newaxis] != detections.labels[np.newaxis, :]] = 0
+
+            # greedy association, best overlap first
+            for flat_index in np.argsort(-overlaps, axis=None):
+                t, d = np.unravel_index(flat_index, overlaps.shape)
+                if overlaps[t, d] < self.iou_threshold:
+                    break
+                if t in matched_tracks or d in matched_detections:
+                    continue
+                self.tracks[t].correct(detections.coords[d], detections.scores[d], detections.labels[d])
+                matched_tracks.add(t)
+                matched_detections.add(d)
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for d in range(len(detections)):
+            if d not in matched_detections:
+                self.tracks.append(KalmanBoxTrack(detections.coords[d], detections.scores[d],
+                                                  detections.labels[d], timestamp))
+
+    def read(self, timestamp):
+        # tracks that missed the latest detection are kept for association only
+        tracks = [track for track in self.tracks if track.misses == 0]
+        if not tracks:
+            return Detections.empty(self.nb_class)
+
+        coords = np.array([track.coords_at(timestamp, self.max_extrapolation) for track in tracks],
+                          dtype=np.float32)
+        scores = np.array([track.score for track in tracks], dtype=np.float32)
+        labels = np.array([track.label for track in tracks], dtype=np.intp)
+        return Detections(coords, scores, labels)
+
+
+def _to_centre(coords):
+    xmin, ymin, xmax, ymax = coords
+    return np.array([(xmin + xmax) / 2., (ymin + ymax) / 2., xmax - xmin, ymax - ymin])
+
+
+def _from_centre(centre):
+    x, y, w, h = centre
+    w, h = max(w, 1e-3), max(h, 1e-3)
+    return np.array([x - w/2., y - h/2., x + w/2., y + h/2.])
@@ -0,0 +1,365 @@
+'''
+Process-isolated inference.
+The object detection model runs in its own worker process so that inference
+no longer competes with the camera and Kivy UI threads for the GIL.
+  1. SharedFrameRing: the camera publishes frames into a ring of shared-memory slots
+  2. SharedDetections: the worker publishes compact detection arrays back
+  3. InferenceWorker: starts, monitors and stops the worker process
+Nothing is pickled per frame; both directions copy straight into shared memory.
+
+Running this script benchmarks UI tick times with inference in a thread versus in the worker:
+  python3 worker.py --model synthetic
+'''
+
+import time
+from multiprocessing import Process, Event, Queue, Lock, Condition
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+import numpy as np
+
+from box_utils import Detections
+from metrics import METRICS
+
+
+class SharedFrameRing:
+    """
+    Ring of shared-memory frame slots, written by one producer and read by any process.
+    Each slot carries the sequence number of the frame in it; readers re-check it
+    after copying, so a frame overwritten mid-copy is never returned.
+    """
+
+    def __init__(self, shape, slots=3):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self._buffer = RawArray('B', int(np.prod(self.shape)) * slots)
+        self._seqs = RawArray('q', [-1] * slots)
+        self._times = RawArray('d', slots)
+        self._latest = RawValue('q', -1)
+        self._condition = Condition()
+        self._views()
+
+    def _views(self):
+        self._frames = np.frombuffer(self._buffer, dtype=np.uint8).reshape((self.slots,) + self.shape)
+        self._read_buffer = None
+
+    # numpy views pickle as copies (spawn/forkserver start methods):
+    # send the shared arrays only, and rebuild the views on them in the worker
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_frames'], state['_read_buffer']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    def write(self, frame, timestamp):
+        seq = self._latest.value + 1
+        slot = seq % self.slots
+
+        self._seqs[slot] = -1  # slot is being written
+        self._frames[slot] = frame
+        self._times[slot] = timestamp
+        self._seqs[slot] = seq
+
+        with self._condition:
+            self._latest.value = seq
+            self._condition.notify_all()
+        return seq
+
+    def read_latest(self, newer_than=-1, timeout=None):
+        """
+        Block until a frame with a sequence number above newer_than exists.
+        Returns (seq, timestamp, frame), or None on timeout. The frame is copied
+        into a buffer owned by the reader, valid until its next read_latest call.
+        """
+        if self._read_buffer is None:
+            self._read_buffer = np.empty(self.shape, dtype=np.uint8)
+
+        while True:
+            with self._condition:
+                if not self._condition.wait_for(lambda: self._latest.value > newer_than, timeout):
+                    return None
+                seq = self._latest.value
+
+            slot = seq % self.slots
+            timestamp = self._times[slot]
+            self._read_buffer[...] = self._frames[slot]
+            if self._seqs[slot] == seq:
+                return seq, timestamp, self._read_buffer
+            # the producer lapped us while copying; take the newer frame instead
+
+
+class SharedDetections:
+    """Latest detection result, as fixed-size shared arrays (coords, score, label per box)"""
+
+    def __init__(self, nb_class, max_boxes=50):
+        self.nb_class = nb_class
+        self.max_boxes = max_boxes
+        self._buffer = RawArray('f', max_boxes * 6)
+        self._count = RawValue('i', 0)
+        self._time = RawValue('d', -1.)
+        self._inference = RawValue('q', 0)
+        self._lock = Lock()
+        self._views()
+
+    def _views(self):
+        self._boxes = np.frombuffer(self._buffer, dtype=np.float32).reshape(self.max_boxes, 6)
+
+    # see SharedFrameRing
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_boxes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    def write(self, detections, timestamp, inference=0):
+        # keep the highest scoring boxes if there are too many
+        keep = np.argsort(-detections.scores)[:self.max_boxes]
+        with self._lock:
+            self._boxes[:len(keep), :4] = detections.coords[keep]
+            self._boxes[:len(keep), 4] = detections.scores[keep]
+            self._boxes[:len(keep), 5] = detections.labels[keep]
+            self._count.value = len(keep)
+            self._time.value = timestamp
+            self._inference.value = inference
+
+    def read(self):
+        """Returns (timestamp of the frame the detections describe, Detections)"""
+        return self.read_inference()[:2]
+
+    def read_inference(self):
+        """Returns (timestamp, Detections, number of the inference that produced them)"""
+        with self._lock:
+            if self._time.value < 0:
+                return None, Detections.empty(self.nb_class), 0
+            boxes = self._boxes[:self._count.value].copy()
+            timestamp = self._time.value
+            inference = self._inference.value
+
+        return timestamp, Detections(boxes[:, :4], boxes[:, 4], boxes[:, 5].astype(np.intp)), inference
+
+
+def _worker_main(model_factory, factory_args, ring, results, counters, min_interval,
+                 samples, ready, stopping, errors):
+    """Entry point of the worker process"""
+    from inference import InferenceLoop
+
+    # stage timings taken here are sent back to the UI process about once a second
+    METRICS.keep_samples()
+    last_sent = time.time()
+
+    try:
+        model = model_factory(*factory_args)
+        model.predict(np.zeros(ring.shape, dtype=np.uint8))  # self-test
+    except Exception as error:
+        errors.put(repr(error))
+        return
+
+    loop = InferenceLoop(model, ring, log_interval=0)
+    ready.set()
+    published = loop.latest
+
+    while not stopping.is_set():
+        loop.min_interval = min_interval.value
+        if loop.step(timeout=0.5):
+            if loop.latest is not published:
+                published = loop.latest
+                results.write(published[1], published[0], published[2])
+            report = loop.report()
+            counters[:] = [report['frames'], report['inferences'], report['cpu_used'], report['cpu_saved']]
+        if time.time() - last_sent > 1.:
+            last_sent = time.time()
+            samples.put(METRICS.drain())
+
+
+class InferenceWorker:
+    """
+    Runs an InferenceLoop in a separate process, fed through a SharedFrameRing.
+    Has the same read/read_timed/read_inference/report/stop interface and min_interval attribute as InferenceLoop.
+
+    Startup: start() forks the worker, which builds the model with
+    model_factory(*factory_args) and runs a self-test; wait_ready() (called by
+    start() unless wait=False) returns once the worker reports ready, and raises
+    RuntimeError if it fails or times out.
+    Shutdown: stop() asks the worker to finish its current frame and exit,
+    and terminates it if it has not exited within the timeout.
+    """
+
+    def __init__(self, model_factory, factory_args, frame_shape, nb_class, slots=3):
+        self.ring = SharedFrameRing(frame_shape, slots)
+        self.results = SharedDetections(nb_class)
+        self._counters = RawArray('d', 4)
+        self._min_interval = RawValue('d', 0.)
+        self._ready = Event()
+        self._stopping = Event()
+        self._errors = Queue()
+        self._samples = Queue()
+        self._process = Process(target=_worker_main,
+                                args=(model_factory, factory_args, self.ring, self.results,
+                                      self._counters, self._min_interval, self._samples,
+                                      self._ready, self._stopping, self._errors))
+        self._process.daemon = True
+
+    def start(self, wait=True, timeout=300):
+        self._process.start()
+        if wait:
+            self.wait_ready(timeout)
+        return self
+
+    def wait_ready(self, timeout=300):
+        deadline = time.time() + timeout
+        while not self._ready.wait(0.5):
+            if not self._errors.empty():
+                raise RuntimeError("Inference worker failed: " + self._errors.get())
+            if not self._process.is_alive():
+                raise RuntimeError("Inference worker exited during startup")
+            if time.time() > deadline:
+                self.stop()
+                raise RuntimeError("Inference worker did not start within {}s".format(timeout))
+        return self
+
+    @property
+    def min_interval(self):
+        """Least seconds between inferences in the worker's InferenceLoop"""
+        return self._min_interval.value
+
+    @min_interval.setter
+    def min_interval(self, seconds):
+        self._min_interval.value = seconds
+
+    def publish(self, frame, timestamp):
+        return self.ring.write(frame, timestamp)
+
+    def read(self):
+        return self.results.read()[1]
+
+    def read_timed(self):
+        return self.results.read()
+
+    def read_inference(self):
+        return self.results.read_inference()
+
+    def collect_metrics(self, metrics=METRICS):
+        """Merge the stage timings the worker has sent since the last call into metrics"""
+        from queue import Empty
+
+        while True:
+            try:
+                metrics.merge(self._samples.get_nowait())
+            except Empty:
+                return
+
+    def report(self):
+        frames, inferences, cpu_used, cpu_saved = self._counters[:]
+        return {'frames': int(frames),
+                'inferences': int(inferences),
+                'skip_ratio': (frames - inferences) / max(frames, 1.),
+                'cpu_used': cpu_used,
+                'cpu_saved': cpu_saved}
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+
+class _SyntheticModel:
+    """Holds the GIL for a fixed time per prediction, like the Python side of model.predict"""
+
+    def __init__(self, seconds, nb_class):
+        self.seconds = seconds
+        self.nb_class = nb_class
+
+    def predict(self, image):
+        with METRICS.time('predict'):
+            deadline = time.time() + self.seconds
+            while time.time() < deadline:
+                pass
+        return Detections.empty(self.nb_class)
+
+
+def _synthetic_model(seconds, nb_class):
+    return _SyntheticModel(seconds, nb_class)
+
+
+def benchmark_ui_ticks(pred, camera, duration=10., interval=0.06, display_size=(1180, 1180)):
+    """
+    Run a MainView.tick-like loop (flip and CPU upscale of every frame)
+    and return the tick durations and the intervals between tick starts, in seconds.
+    """
+    import cv2
+
+    durations, intervals = [], []
+    last_start = None
+    end = time.time() + duration
+
+    while time.time() < end:
+        start = time.time()
+        if last_start is not None:
+            intervals.append(start - last_start)
+        last_start = start
+
+        image = camera.read()
+        pred.read()
+        cv2.resize(cv2.flip(image, 0), display_size).tobytes()
+
+        durations.append(time.time() - start)
+        time.sleep(max(interval - (time.time() - start), 0))
+
+    return np.array(durations), np.array(intervals)
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import model_cache
+    from camera import SyntheticSource
+    from inference import InferenceLoop
+
+    parser = argparse.ArgumentParser(description='Compare UI tick times with threaded and process inference')
+    parser.add_argument('--model', choices=['synthetic', 'keras'], default='synthetic')
+    parser.add_argument('--config', default='data/config.json')
+    parser.add_argument('--weights', default='data/best_weights_11.h5')
+    parser.add_argument('--synthetic-seconds', type=float, default=0.5,
+                        help='time the synthetic model holds the GIL per prediction')
+    parser.add_argument('--duration', type=float, default=10.)
+    args = parser.parse_args()
+
+    with open(args.config) as config_buffer:
+        config = json.load(config_buffer)['model']
+    shape = (config['input_size'], config['input_size'], 3)
+    nb_class = len(config['labels'])
+
+    if args.model == 'synthetic':
+        factory, factory_args = _synthetic_model, (args.synthetic_seconds, nb_class)
+    else:
+        factory, factory_args = model_cache.load_model, (args.config, args.weights)
+
+    for design in ('thread', 'process'):
+        camera = SyntheticSource(shape[1::-1])
+        if design == 'thread':
+            pred = InferenceLoop(factory(*factory_args), camera, log_interval=0)
+            camera.start()
+            pred.start()
+        else:
+            pred = InferenceWorker(factory, factory_args, shape, nb_class).start()
+            camera.ring = pred.ring
+            camera.start()
+
+        camera.read_latest(timeout=5)  # wait for the first frame
+        durations, intervals = benchmark_ui_ticks(pred, camera, args.duration)
+        report = pred.report()
+        pred.stop()
+        camera.stop()
+
+        print("{:<8} tick p50 {:.1f}ms p95 {:.1f}ms max {:.1f}ms | interval p95 {:.1f}ms max {:.1f}ms | {} inferences".format(
+            design,
+            np.percentile(durations, 50) * 1000, np.percentile(durations, 95) * 1000, durations.max() * 1000,
+            np.percentile(intervals, 95) * 1000, intervals.max() * 1000,
+            report['inferences']))